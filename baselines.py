@@ -3,6 +3,7 @@ from itertools import product
 import numpy as np
 
 from basestation import Basestation
+from slice import Slice
 
 
 class BaselineAgent:
@@ -20,6 +21,7 @@ class BaselineAgent:
         bandwidth: float = 100000000,
         total_number_rbs: int = 17,
         packet_size: int = 8192 * 8,
+        obs_fields: dict = None,
     ) -> None:
         if type == "mt":
             self.predict = self.max_throughput
@@ -35,12 +37,19 @@ class BaselineAgent:
         self.action_space = Basestation.create_combinations(
             total_rbs, slices_number, full=True
         )
+        # Observation layout of the basestation, the default one is the
+        # partial observation space with the requirements of three slices
+        self.obs_fields = (
+            Basestation.create_obs_fields(8, slices_number, Slice.hist_labels)
+            if obs_fields is None
+            else obs_fields
+        )
         self.round_robin_alloc = [6, 6, 5]
         self.vec_throughput_snt = np.empty((0, 3))
 
     def max_throughput(self, obs: np.array) -> int:
-        se = obs[[14, 23, 32]] # Spectral efficiency?
-        buffer_occ = obs[[11, 20, 29]]
+        se = obs[self.obs_fields["slice_se"]]
+        buffer_occ = obs[self.obs_fields["slice_buffer_occ"]]
         total_throughput_avail = np.min(
             [
                 se * self.bandwidth,
@@ -58,10 +67,10 @@ class BaselineAgent:
 
     def proportional_fair(self, obs: np.array) -> int:
         self.vec_throughput_snt = np.append(
-            self.vec_throughput_snt, [obs[[9, 18, 27]]], axis=0
+            self.vec_throughput_snt, [obs[self.obs_fields["slice_pkt_snt"]]], axis=0
         )
-        se = obs[[14, 23, 32]]
-        buffer_occ = obs[[11, 20, 29]]
+        se = obs[self.obs_fields["slice_se"]]
+        buffer_occ = obs[self.obs_fields["slice_buffer_occ"]]
         total_throughput_avail = np.min(
             [
                 se * self.bandwidth,
@@ -1,5 +1,6 @@
 import os
-from itertools import product
+from itertools import chain, combinations
+from math import comb
 
 import gymnasium as gym
 import matplotlib.pyplot as plt
@@ -9,6 +10,11 @@ from numpy.random import BitGenerator
 from numpy.testing._private.utils import requires_memory
 from tqdm import tqdm
 
+from buffer import BufferBank
+from history import HistoryStore
+from history_writer import HistoryWriter
+from plot_queue import PlotQueue
+from reward import Reward
 from slice import Slice
 from ue import UE
 
@@ -24,6 +30,7 @@ class Basestation(gym.Env):
     """
 
     metadata = {"render.modes": ["human"]}
+    combinations_cache = {}  # RBs allocations created in this process
 
     def __init__(
         self,
@@ -40,6 +47,7 @@ class Basestation(gym.Env):
         total_number_rbs: int = 17,
         max_number_steps: int = 2000,
         max_number_trials: int = 50,
+        initial_trial: int = 1,
         windows_size_obs: int = 100,
         steps_update_traffics: int = 200,
         obs_space_mode: str = "partial",
@@ -52,6 +60,19 @@ class Basestation(gym.Env):
         baseline: bool = False,
         root_path: str = ".",
         agent_type: str = "main",
+        history_level: str = "full",
+        history_decimation: int = 1,
+        record_aux_hist: bool = True,
+        action_projection: str = "table",
+        reuse_scenario: bool = True,
+        precompute_traffic: bool = False,
+        traffic_schedules: dict = None,
+        scheduler: str = "rr",
+        async_hist: bool = False,
+        history_chunk_size: int = 100,
+        plot_queue=None,
+        channel: str = "recorded",
+        channel_seed: int = 0,
     ) -> None:
         self.bs_name = bs_name
         self.max_packets_buffer = max_packets_buffer
@@ -63,6 +84,7 @@ class Basestation(gym.Env):
         self.total_number_rbs = total_number_rbs
         self.max_number_steps = max_number_steps
         self.max_number_trials = max_number_trials
+        self.initial_trial = initial_trial  # Trials cycle from initial to max
         self.traffic_types = traffic_types
         self.step_number = 0
         self.trial_number = 1
@@ -83,11 +105,62 @@ class Basestation(gym.Env):
         self.root_path = root_path
         self.rng = rng
         self.agent_type = agent_type
+        self.history_level = history_level  # "off", "summary" or "full"
+        self.history_decimation = history_decimation
+        self.record_aux_hist = record_aux_hist  # Data for the optimization model
         self.seed = 0  # Requested by Stablebaselines agent
+        # "table": nearest allocation searched in all RBs combinations
+        # "direct": nearest allocation calculated by project_action()
+        self.action_projection = action_projection
+        self.reuse_scenario = reuse_scenario  # Reset UEs and slices in place
+        # Traffic levels and UE arrivals of the episode drawn at once in reset
+        self.precompute_traffic = precompute_traffic
+        self.traffic_schedule = None
+        # Frozen schedules of each trial number, replayed in every reset
+        self.traffic_schedules = traffic_schedules
+        self.scheduler = scheduler  # Intra-slice scheduler of all slices
+        # Saved hists are written in chunks by a background thread
+        self.history_writer = HistoryWriter() if async_hist and save_hist else None
+        self.history_chunk_size = history_chunk_size
+        # Plots are submitted with the in-memory hists to a PlotQueue instead
+        # of being rendered in the step that saves the hists. With async hists,
+        # plots are rendered alongside the simulation by an own PlotQueue
+        # (closed in close()), since pyplot must not run in the writer thread
+        self.own_plot_queue = (
+            plot_queue is None
+            and self.history_writer is not None
+            and (plots or slice_plots or ue_plots)
+        )
+        self.plot_queue = (
+            PlotQueue(deferred=False) if self.own_plot_queue else plot_queue
+        )
+        # "recorded": SE store values of each trial and UE
+        # "trace": recorded values reused with time offsets for any number of
+        # UEs and steps
+        # "synthetic": SE generated for each trial and UE, without files
+        self.channel = channel
+        self.channel_seed = channel_seed
+        if action_projection not in ["table", "direct"]:
+            raise Exception(
+                'Action projection "{}" is not valid'.format(action_projection)
+            )
+        if channel not in ["recorded", "trace", "synthetic"]:
+            raise Exception('Channel "{}" is not valid'.format(channel))
+        if (plots or slice_plots or ue_plots) and history_level != "full":
+            raise Exception('Plots require the "full" history level')
 
+        if self.precompute_traffic:
+            self.traffic_schedule = self.create_traffic_schedule()
         self.ues, self.slices = self.create_scenario()
-        self.action_space_options = self.create_combinations(
-            self.total_number_rbs, self.slices.shape[0], baseline
+        self.action_space_options = (
+            self.create_combinations(
+                self.total_number_rbs,
+                self.slices.shape[0],
+                baseline,
+                "{}/combinations".format(self.root_path),
+            )
+            if self.action_projection == "table"
+            else None
         )
         self.action_space = spaces.Box(low=-1, high=1, shape=(self.slices.shape[0],))
 
@@ -130,15 +203,18 @@ class Basestation(gym.Env):
                 )
             )
 
-        self.hist_labels = [ # 
+        self.hist_labels = [ # Colocar obs space
             "actions",
             "rewards",
-            "" # ------------------------ Colocar obs space
         ]
-        self.hist = {
-            hist_label: np.array([]) if hist_label != "actions" else np.empty((0, 3))
-            for hist_label in self.hist_labels
-        }
+        self.hist = HistoryStore(
+            self.hist_labels,
+            self.max_number_steps,
+            [self.slices.shape[0], 1],
+            level=self.history_level,
+            decimation=self.history_decimation,
+        )
+        self.stream_hist()
         self.slice_req_norm_factors = (
             [
                 100,
@@ -153,6 +229,20 @@ class Basestation(gym.Env):
             if self.normalize_ue_obs
             else [1, 1, 1, 1, 1, 1, 1, 1]
         )
+        self.obs_fields = self.create_obs_fields(
+            sum(len(item) for item in self.slice_requirements.values()),
+            self.slices.shape[0],
+            Slice.hist_labels,
+            self.ues.shape[0] if self.obs_space_mode == "full" else 0,
+        )
+        self.obs = np.zeros(self.observation_space.shape, dtype=np.float32)
+        self.update_obs_requirements()
+        self.reward_function = Reward(
+            self.agent_type,
+            [slice.name for slice in self.slices],
+            Slice.hist_labels,
+        )
+        self.reward_function.compile(self)
 
     def step(self, action: np.array, action_already_integer=False):
         """
@@ -167,10 +257,15 @@ class Basestation(gym.Env):
                 * (1 / action.shape[0])
                 * self.total_number_rbs
             )
-            action_idx = np.argmin(
-                np.sum(np.abs(self.action_space_options - rbs_allocation), axis=1)
-            )
-            action_values = self.action_space_options[action_idx]
+            if self.action_projection == "direct":
+                action_values = self.project_action(
+                    rbs_allocation, self.total_number_rbs
+                )
+            else:
+                action_idx = np.argmin(
+                    np.sum(np.abs(self.action_space_options - rbs_allocation), axis=1)
+                )
+                action_values = self.action_space_options[action_idx]
         else:
             action_values = action # For using the optimization model result
         for i in range(len(action_values)):
@@ -191,24 +286,33 @@ class Basestation(gym.Env):
         if self.step_number % self.steps_update_traffics == 0:
             self.update_ues_traffic()
 
+        # Copied, since wrappers keep the last observation of the episode after
+        # calling reset()
         return (
-            self.get_obs_space(),
+            self.get_obs_space().copy(),
             reward,
             self.step_number == (self.max_number_steps),
             False,
             {},
         )
 
-    def reset(self, initial_trial: int = -1, seed: int = None):
+    def reset(
+        self, initial_trial: int = -1, seed: int = None, traffic_schedule: dict = None
+    ):
         """
         Reset the UEs and Slices to enable the environment to start other
         episode without past residuous. The reset function increases
-        the number of trials when a trial is finished.
+        the number of trials when a trial is finished. A traffic_schedule
+        returned by create_traffic_schedule() replays the traffic of a
+        previous episode, as the schedule of the trial in traffic_schedules
+        does. Otherwise, a new one is drawn when precompute_traffic is enabled.
         """
         if (self.step_number == 0 and self.trial_number == 1) or (
             self.trial_number == self.max_number_trials
         ):
-            self.trial_number = 1 if initial_trial == -1 else initial_trial
+            self.trial_number = (
+                self.initial_trial if initial_trial == -1 else initial_trial
+            )
         elif self.trial_number < self.max_number_trials:
             self.trial_number += 1
         else:
@@ -218,29 +322,63 @@ class Basestation(gym.Env):
                 )
             )
         self.step_number = 0
+        if traffic_schedule is not None:
+            self.traffic_schedule = traffic_schedule
+        elif self.traffic_schedules is not None:
+            if self.trial_number not in self.traffic_schedules:
+                raise Exception(
+                    "No traffic schedule was given for trial {}".format(
+                        self.trial_number
+                    )
+                )
+            self.traffic_schedule = self.traffic_schedules[self.trial_number]
+        elif self.precompute_traffic:
+            self.traffic_schedule = self.create_traffic_schedule()
+        else:
+            self.traffic_schedule = None  # Traffic drawn in each step
 
-        self.ues, self.slices = self.create_scenario()
-        self.hist_labels = [
-            "actions",
-            "rewards",
-        ]
-        self.hist = {
-            hist_label: np.array([]) if hist_label != "actions" else np.empty((0, 3))
-            for hist_label in self.hist_labels
-        }
+        if self.reuse_scenario:
+            self.reset_scenario()
+        else:
+            self.ues, self.slices = self.create_scenario()
+        self.hist.reset()
+        self.stream_hist()
 
-        return (self.get_obs_space(), {})
+        return (self.get_obs_space().copy(), {})
 
     def render(self, mode="human"):
         pass
 
     def close(self):
-        pass
+        if self.history_writer is not None:
+            self.history_writer.close()
+        if self.own_plot_queue:
+            self.plot_queue.close()
 
     def create_scenario(self):
         """
-        Creates UEs and slices as specified in the basestation init.
+        Creates UEs and slices as specified in the basestation init. The UE
+        buffers are stored in a single BufferBank with the rows grouped by
+        slice, so each slice works over a contiguous view of the bank. The last
+        hist values of UEs and slices are written in matrices following the
+        same order, which are copied to the observation space at once.
         """
+        values, indexes = np.unique(self.traffic_types, return_inverse=True)
+        buffer_rows = np.empty(self.number_ues, dtype=int)
+        buffer_rows[np.argsort(indexes, kind="stable")] = np.arange(self.number_ues)
+        slice_rows = np.concatenate(([0], np.cumsum(np.bincount(indexes))))
+        self.buffer_bank = BufferBank(
+            self.number_ues, self.max_packets_buffer, self.buffer_max_lat
+        )
+        self.ues_hist_last = np.zeros(
+            (self.number_ues, len(UE.hist_labels)), dtype=np.float32
+        )
+        self.ues_no_windows_hist_last = np.zeros_like(self.ues_hist_last)
+        self.slices_hist_last = np.zeros(
+            (len(values), len(Slice.hist_labels)), dtype=np.float32
+        )
+        self.slices_no_windows_hist_last = np.zeros_like(self.slices_hist_last)
+
         ues = np.array(
             [
                 UE(
@@ -251,17 +389,34 @@ class Basestation(gym.Env):
                     traffic_throughput=self.traffic_throughputs[
                         list(self.traffic_throughputs.keys())[0]
                     ][self.traffic_types[i - 1]],
+                    max_packets_buffer=self.max_packets_buffer,
+                    buffer_max_lat=self.buffer_max_lat,
+                    max_number_steps=self.max_number_steps,
                     plots=self.ue_plots,
                     rng=self.rng,
                     windows_size_obs=self.windows_size_obs,
                     normalize_obs=self.normalize_ue_obs,
                     root_path=self.root_path,
+                    buffer_bank=self.buffer_bank,
+                    buffer_index=buffer_rows[i - 1],
+                    history_level=self.history_level,
+                    history_decimation=self.history_decimation,
+                    record_aux_hist=self.record_aux_hist,
+                    hist_last=self.ues_hist_last[buffer_rows[i - 1]],
+                    no_windows_hist_last=self.ues_no_windows_hist_last[
+                        buffer_rows[i - 1]
+                    ],
+                    arrivals=self.get_ue_arrivals(i),
+                    history_writer=self.history_writer,
+                    history_chunk_size=self.history_chunk_size,
+                    plot_queue=self.plot_queue,
+                    channel=self.channel,
+                    channel_seed=self.channel_seed,
                 )
                 for i in np.arange(1, self.number_ues + 1)
             ]
         )
 
-        values, indexes = np.unique(self.traffic_types, return_inverse=True)
         # Slices follows an alphabetical order
         slices = np.array(
             [
@@ -275,6 +430,22 @@ class Basestation(gym.Env):
                     plots=self.slice_plots,
                     save_hist=self.save_hist_bool,
                     root_path=self.root_path,
+                    buffer_bank=self.buffer_bank.view(
+                        slice_rows[i - 1], slice_rows[i]
+                    ),
+                    max_number_steps=self.max_number_steps,
+                    history_level=self.history_level,
+                    history_decimation=self.history_decimation,
+                    hist_last=self.slices_hist_last[i - 1],
+                    no_windows_hist_last=self.slices_no_windows_hist_last[i - 1],
+                    ues_hist_last=self.ues_hist_last[slice_rows[i - 1] : slice_rows[i]],
+                    ues_no_windows_hist_last=self.ues_no_windows_hist_last[
+                        slice_rows[i - 1] : slice_rows[i]
+                    ],
+                    scheduler=self.scheduler,
+                    history_writer=self.history_writer,
+                    history_chunk_size=self.history_chunk_size,
+                    plot_queue=self.plot_queue,
                 )
                 for i in range(1, len(values) + 1)
             ]
@@ -282,228 +453,108 @@ class Basestation(gym.Env):
 
         return ues, slices
 
+    def reset_scenario(self) -> None:
+        """
+        Reset the UEs and slices in place for the current trial, obtaining the
+        same state of create_scenario() without creating new objects. UEs are
+        reset following their ids order, as they are created, so the initial
+        packets are drawn in the same order.
+        """
+        for ue in self.ues:
+            ue.reset(
+                self.trial_number,
+                self.traffic_throughputs[list(self.traffic_throughputs.keys())[0]][
+                    ue.traffic_type
+                ],
+                self.get_ue_arrivals(ue.id),
+            )
+        for slice in self.slices:
+            slice.reset(self.trial_number, self.slice_requirements[slice.name])
+
     def get_obs_space(self):
         """
         Get observation space variable that is composed by slices and UEs
-        information.
+        information. The values are copied to a preallocated array following
+        the layout given by the obs_fields, so the returned array is
+        overwritten in the next steps (step() and reset() return copies).
         """
-        slice_requirements = np.array([])
-        observation_slices = np.array([])
-        observation_ues = np.array([])
-        slices_ordered = ["embb", "urllc", "be"]
-        normalization_idx = 0
-        for slice_req in slices_ordered:
-            for attribute in self.slice_requirements[slice_req]:
-                slice_requirements = np.append(
-                    slice_requirements,
-                    (
-                        self.slice_requirements[slice_req][attribute]
-                        / self.slice_req_norm_factors[normalization_idx]
-                    ),
-                )
-                normalization_idx += 1
+        self.obs[self.obs_fields["requirements"]] = self.obs_requirements
+        self.obs[self.obs_fields["slices"]] = self.slices_hist_last.reshape(-1)
+        if self.obs_space_mode == "full":
+            self.obs[self.obs_fields["ues"]] = self.ues_hist_last.reshape(-1)
 
-        for slice in self.slices:
-            for array in slice.hist.values():
-                observation_slices = np.append(
-                    observation_slices, (array[-1] if len(array) != 0 else 0)
-                )
+        return self.obs
 
-            for ue in slice.ues:
-                for array in ue.hist.values():
-                    observation_ues = np.append(
-                        observation_ues, (array[-1] if len(array) != 0 else 0)
-                    )
-        obs_space = (
-            np.concatenate(
-                (slice_requirements, observation_slices, observation_ues), axis=None
-            )
-            if self.obs_space_mode == "full"
-            else np.concatenate((slice_requirements, observation_slices), axis=None)
+    def update_obs_requirements(self) -> None:
+        """
+        Update the normalized slice requirements used in the observation space.
+        """
+        slices_ordered = ["embb", "urllc", "be"]
+        self.obs_requirements = np.fromiter(
+            (
+                value
+                for slice_req in slices_ordered
+                for value in self.slice_requirements[slice_req].values()
+            ),
+            dtype=np.float64,
         )
+        self.obs_requirements /= self.slice_req_norm_factors[
+            : self.obs_requirements.shape[0]
+        ]
 
-        return obs_space
+    @staticmethod
+    def create_obs_fields(
+        number_requirements: int,
+        number_slices: int,
+        hist_labels: list,
+        number_ues: int = 0,
+    ) -> dict:
+        """
+        Create the observation space layout, which is composed by the slice
+        requirements (eMBB, URLLC and BE), the hist of each slice (alphabetical
+        order) and the hist of each UE (ordered by slice), when number_ues is
+        not 0. The "requirements", "slices" and "ues" keys contain the slice of
+        each part, while the "slice_{label}" and "ue_{label}" keys contain the
+        index of the hist label of each slice and UE, e.g., obs[fields["slice_se"]]
+        returns the spectral efficiency of all slices.
+        """
+        number_labels = len(hist_labels)
+        slices_start = number_requirements
+        ues_start = slices_start + number_slices * number_labels
+        fields = {
+            "requirements": slice(0, slices_start),
+            "slices": slice(slices_start, ues_start),
+            "ues": slice(ues_start, ues_start + number_ues * number_labels),
+        }
+        for i, label in enumerate(hist_labels):
+            fields["slice_{}".format(label)] = (
+                slices_start + np.arange(number_slices) * number_labels + i
+            )
+            fields["ue_{}".format(label)] = (
+                ues_start + np.arange(number_ues) * number_labels + i
+            )
+
+        return fields
 
     def calculate_reward(self) -> float:
         """
         Calculates the environment reward for the action taken. It considers
         the slices requirements as basis to formulate how good was the action.
+        The reward of each agent type is defined in the Reward class.
         """
-        if self.agent_type == "main":
-            w_embb_thr = 0.2
-            w_embb_lat = 0.05
-            w_embb_loss = 0.05
-            w_urllc_thr = 0.1
-            w_urllc_lat = 0.25
-            w_urllc_loss = 0.25
-            w_be_long = 0.05
-            w_be_fifth = 0.05
-            reward = 0
-            for slice in self.slices:
-                slice_hist = slice.get_last_no_windows_hist()
-                if slice.name == "embb":
-                    req_thr_normalized = (
-                        self.slice_requirements["embb"]["throughput"]
-                        / self.slice_req_norm_factors[0]
-                    )
-                    req_lat_normalized = (
-                        self.slice_requirements["embb"]["latency"]
-                        / self.slice_req_norm_factors[1]
-                    )
-                    req_pkt_loss_normalized = (
-                        self.slice_requirements["embb"]["pkt_loss"]
-                        / self.slice_req_norm_factors[2]
-                    )
-
-                    # Throughput contribution
-                    reward += (
-                        -w_embb_thr
-                        * (
-                            (req_thr_normalized - slice_hist["pkt_thr"])
-                            / req_thr_normalized
-                        )
-                        if slice_hist["pkt_thr"] < req_thr_normalized
-                        else 0
-                    )
-                    # Latency contribution
-                    reward += (
-                        0
-                        if slice_hist["avg_lat"] <= req_lat_normalized
-                        else -w_embb_lat
-                        * (slice_hist["avg_lat"] - req_lat_normalized)
-                        / (
-                            (self.buffer_max_lat / self.slice_req_norm_factors[1])
-                            - req_lat_normalized
-                        )
-                    )
-                    # Packet loss contribution
-                    reward += (
-                        0
-                        if slice_hist["pkt_loss"] <= req_pkt_loss_normalized
-                        else -w_embb_loss
-                        * (slice_hist["pkt_loss"] - req_pkt_loss_normalized)
-                        / (1 - req_pkt_loss_normalized)
-                    )
-                elif slice.name == "urllc":
-                    req_thr_normalized = (
-                        self.slice_requirements["urllc"]["throughput"]
-                        / self.slice_req_norm_factors[3]
-                    )
-                    req_lat_normalized = (
-                        self.slice_requirements["urllc"]["latency"]
-                        / self.slice_req_norm_factors[4]
-                    )
-                    req_pkt_loss_normalized = (
-                        self.slice_requirements["urllc"]["pkt_loss"]
-                        / self.slice_req_norm_factors[5]
-                    )
-
-                    # Throughput contribution
-                    reward += (
-                        -w_urllc_thr
-                        * (
-                            (req_thr_normalized - slice_hist["pkt_thr"])
-                            / req_thr_normalized
-                        )
-                        if slice_hist["pkt_thr"] < req_thr_normalized
-                        else 0
-                    )
-                    # Latency contribution
-                    reward += (
-                        0
-                        if slice_hist["avg_lat"] <= req_lat_normalized
-                        else -w_urllc_lat
-                        * (slice_hist["avg_lat"] - req_lat_normalized)
-                        / (
-                            (self.buffer_max_lat / self.slice_req_norm_factors[1])
-                            - req_lat_normalized
-                        )
-                    )
-                    # Packet loss contribution
-                    reward += (
-                        0
-                        if slice_hist["pkt_loss"] <= req_pkt_loss_normalized
-                        else -w_urllc_loss
-                        * (slice_hist["pkt_loss"] - req_pkt_loss_normalized)
-                        / (1 - req_pkt_loss_normalized)
-                    )
-                elif slice.name == "be":
-                    req_long_thr_normalized = (
-                        self.slice_requirements["be"]["long_term_pkt_thr"]
-                        / self.slice_req_norm_factors[6]
-                    )
-                    req_fifth_thr_normalized = (
-                        self.slice_requirements["be"]["fifth_perc_pkt_thr"]
-                        / self.slice_req_norm_factors[7]
-                    )
-
-                    # Long term average throughput contribution
-                    reward += (
-                        -w_be_long
-                        * (
-                            (req_long_thr_normalized - slice_hist["long_term_pkt_thr"])
-                            / req_long_thr_normalized
-                        )
-                        if slice_hist["long_term_pkt_thr"] < req_long_thr_normalized
-                        else 0
-                    )
-                    # Fifth percentile throughput contribution
-                    reward += (
-                        -w_be_fifth
-                        * (
-                            (
-                                req_fifth_thr_normalized
-                                - slice_hist["fifth_perc_pkt_thr"]
-                            )
-                            / req_fifth_thr_normalized
-                        )
-                        if slice_hist["fifth_perc_pkt_thr"] < req_fifth_thr_normalized
-                        else 0
-                    )
-        elif self.agent_type == "intentless":
-            embb_weights = np.array([1, 0.5, 2e-4])
-            be_weights = np.array([1, 0.5, 2e-4]) * (1 / 5)
-            urllc_weights = np.array([2, 1, 4e-4])
-            reward = 0
-            for slice in self.slices:
-                slice_hist = slice.get_last_no_windows_hist()
-
-                if slice.name == "embb":
-                    weights = embb_weights
-                elif slice.name == "urllc":
-                    weights = urllc_weights
-                elif slice.name == "be":
-                    weights = be_weights
-
-                reward += (
-                    weights[0] * np.exp(-slice_hist["avg_lat"])
-                    + weights[1] * np.exp(-slice_hist["pkt_loss"])
-                    + weights[2] * slice_hist["pkt_thr"]
-                )
-        elif self.agent_type == "colran":
-            reward = 0
-            for slice in self.slices:
-                slice_hist = slice.get_last_no_windows_hist()
-
-                if slice.name == "embb":
-                    reward += slice_hist["pkt_thr"]
-                elif slice.name == "urllc":
-                    reward -= (
-                        slice_hist["buffer_occ"]
-                        * self.max_packets_buffer
-                        * self.packet_size
-                    ) / 1e6
-                elif slice.name == "be":
-                    reward += slice_hist["fifth_perc_pkt_thr"]
-
-        return reward
+        return self.reward_function.calculate(self.slices_no_windows_hist_last)
 
     def update_ues_traffic(self) -> None:
         self.slice_requirements = {}
-        for slice in self.slices:
-            traffic_level = self.rng.integers(len(self.traffic_throughputs))
+        update = self.step_number // self.steps_update_traffics - 1
+        for i, slice in enumerate(self.slices):
+            if self.traffic_schedule is None:
+                traffic_level = self.rng.integers(len(self.traffic_throughputs))
+                be_prob = self.rng.random()
+            else:
+                traffic_level = self.traffic_schedule["traffic_levels"][update, i]
+                be_prob = self.traffic_schedule["be_probs"][update, i]
             is_be = slice.name == "be"
-            be_prob = self.rng.random()
             self.slice_requirements[slice.name] = (
                 {"long_term_pkt_thr": 0, "fifth_perc_pkt_thr": 0}
                 if is_be and be_prob > 0.5
@@ -521,9 +572,82 @@ class Basestation(gym.Env):
                         list(self.traffic_throughputs.keys())[traffic_level]
                     ][ue.traffic_type]
                 )
+        self.update_obs_requirements()
+        self.reward_function.compile(self)
+
+    def create_traffic_schedule(self) -> dict:
+        """
+        Draw the traffic of the whole episode at once: the traffic level and BE
+        probability of each slice in each traffic update (used by
+        update_ues_traffic()) and the packets arriving at each UE (rows
+        following the UE ids) before each step, where the column 0 contains
+        the initial packets and the column i the packets drawn in the step
+        i - 1. The arrivals follow the throughputs given by the traffic
+        updates, with the first traffic level until the first update.
+        """
+        slice_names, ue_slices = np.unique(self.traffic_types, return_inverse=True)
+        traffic_levels_names = list(self.traffic_throughputs.keys())
+        number_updates = self.max_number_steps // self.steps_update_traffics
+        traffic_levels = self.rng.integers(
+            len(traffic_levels_names), size=(number_updates, slice_names.shape[0])
+        )
+        be_probs = self.rng.random((number_updates, slice_names.shape[0]))
+
+        # Throughput of each UE in each traffic period (-1 when BE is off)
+        levels_throughputs = np.array(
+            [
+                [
+                    self.traffic_throughputs[level][traffic_type]
+                    for level in traffic_levels_names
+                ]
+                for traffic_type in self.traffic_types
+            ],
+            dtype=float,
+        )
+        periods_throughputs = np.concatenate(
+            (
+                levels_throughputs[:, :1],
+                np.where(
+                    (slice_names[ue_slices] == "be")[:, np.newaxis]
+                    & (be_probs[:, ue_slices].T > 0.5),
+                    -1,
+                    np.take_along_axis(
+                        levels_throughputs, traffic_levels[:, ue_slices].T, axis=1
+                    ),
+                ),
+            ),
+            axis=1,
+        )
+        steps_periods = np.maximum(np.arange(self.max_number_steps + 1) - 1, 0) // (
+            self.steps_update_traffics
+        )
+        throughputs = periods_throughputs[:, steps_periods]
+        arrivals = self.rng.poisson(
+            np.where(throughputs != -1, throughputs * 1e3 / self.packet_size, 0)
+        )
+
+        return {
+            "traffic_levels": traffic_levels,
+            "be_probs": be_probs,
+            "arrivals": arrivals,
+        }
+
+    def get_ue_arrivals(self, ue_id: int) -> np.array:
+        """
+        Return the precomputed arrivals of the UE, or None if they are drawn in
+        each step.
+        """
+        if self.traffic_schedule is None:
+            return None
+        return self.traffic_schedule["arrivals"][ue_id - 1]
 
     @staticmethod
-    def create_combinations(total_rbs: int, number_slices: int, full=False):
+    def create_combinations(
+        total_rbs: int,
+        number_slices: int,
+        full=False,
+        cache_path: str = "./combinations",
+    ):
         """
         Create the combinations of possible arrays with RBs allocation for each
         slice. For instance, let's assume 3 slices and 17 RBs available in the
@@ -535,37 +659,167 @@ class Basestation(gym.Env):
         action taken by RL agent is a discrete number that represents the index
         of the option into the array with all possible RBs allocations for
         these slices.
+
+        The combinations are kept in memory for the next calls in the same
+        process and saved in cache_path (if it is not None) for other
+        processes. The returned array is shared, so it is read-only.
         """
+        key = (total_rbs, number_slices)
+        if key not in Basestation.combinations_cache:
+            path = (
+                "{}/combinations_rbs{}_slices{}.npy".format(
+                    cache_path, total_rbs, number_slices
+                )
+                if cache_path is not None
+                else None
+            )
+            try:
+                combinations = np.load(path)
+            except (OSError, TypeError, ValueError):
+                combinations = Basestation.enumerate_combinations(
+                    total_rbs, number_slices
+                )
+                if path is not None:
+                    try:
+                        os.makedirs(cache_path, exist_ok=True)
+                        # Written to a temporary file and renamed, so parallel
+                        # processes never read a partial file
+                        tmp_path = "{}.{}.tmp.npy".format(path[:-4], os.getpid())
+                        np.save(tmp_path, combinations)
+                        os.replace(tmp_path, path)
+                    except OSError:
+                        pass
+            combinations.flags.writeable = False
+            Basestation.combinations_cache[key] = combinations
+        return Basestation.combinations_cache[key]
 
-        combinations = []
-        combs = product(range(0, total_rbs + 1), repeat=number_slices)
-        for comb in combs:
-            if np.sum(comb) == total_rbs:
-                combinations.append(comb)
-        return np.asarray(combinations)
+    @staticmethod
+    def project_action(rbs_allocation: np.array, total_rbs: int) -> np.array:
+        """
+        Return the RBs allocation (summation equal to total_rbs) with the
+        minimum L1 distance to the real-valued rbs_allocation, which is the
+        one selected from create_combinations() in the "table" projection.
+        It uses the largest remainder rounding: all values are rounded down
+        and the remaining RBs are given to the slices with the largest
+        fractional parts. Ties are given to the last slices, as the first
+        combination in lexicographic order. When distinct allocations have
+        the same distance (e.g., fractional parts equal to 0.5), the table
+        search may pick another one due to rounding errors. The allocations of
+        several basestations can be calculated at once using one per row.
+        """
+        allocation = np.floor(rbs_allocation)
+        remainders = rbs_allocation - allocation
+        missing_rbs = np.round(
+            total_rbs - np.sum(allocation, axis=-1, keepdims=True)
+        )
+        # Rank of each slice remainder, ranking the last slices first in ties
+        order = np.argsort(-remainders[..., ::-1], axis=-1, kind="stable")
+        ranks = np.empty_like(order)
+        np.put_along_axis(
+            ranks, order, np.broadcast_to(np.arange(order.shape[-1]), order.shape), -1
+        )
+        allocation += ranks[..., ::-1] < missing_rbs
+
+        return allocation.astype(int)
+
+    @staticmethod
+    def enumerate_combinations(total_rbs: int, number_slices: int) -> np.array:
+        """
+        Enumerate the RBs allocations in lexicographic order using stars and
+        bars: each allocation corresponds to the positions of number_slices - 1
+        bars among total_rbs + number_slices - 1 places, and the RBs of each
+        slice are the number of places between two consecutive bars. Only
+        valid allocations are created, instead of filtering all arrays with
+        values from 0 to total_rbs.
+        """
+        number_places = total_rbs + number_slices - 1
+        number_bars = number_slices - 1
+        number_combinations = comb(number_places, number_bars)
+        bars = np.fromiter(
+            chain.from_iterable(combinations(range(number_places), number_bars)),
+            dtype=np.int64,
+            count=number_combinations * number_bars,
+        ).reshape(number_combinations, number_bars)
+        bars = np.concatenate(
+            (
+                np.full((bars.shape[0], 1), -1),
+                bars,
+                np.full((bars.shape[0], 1), number_places),
+            ),
+            axis=1,
+        )
+        return np.diff(bars, axis=1) - 1
 
     def update_hist(self, action_rbs, reward):
         """
         Update the hist values concerned to the basestation.
         """
-        self.hist["actions"] = np.vstack((self.hist["actions"], action_rbs))
-        self.hist["rewards"] = np.append(self.hist["rewards"], reward, axis=None)
+        self.hist.append(np.append(action_rbs, reward))
+
+    def get_hist_path(self) -> str:
+        return "{}/hist/{}/trial{}/".format(
+            self.root_path, self.bs_name, self.trial_number
+        )
+
+    def stream_hist(self) -> None:
+        """
+        Stream the hist of the current trial to the history writer.
+        """
+        if self.history_writer is not None:
+            self.hist.stream(
+                self.history_writer,
+                self.get_hist_path() + "bs",
+                self.history_chunk_size,
+            )
 
     def save_hist(self) -> None:
         """
         Save variables history to external file.
         """
-        path = ("{}/hist/{}/trial{}/").format(
-            self.root_path, self.bs_name, self.trial_number
-        )
-        try:
-            os.makedirs(path)
-        except OSError:
-            pass
+        path = self.get_hist_path()
+        if self.history_writer is None:
+            try:
+                os.makedirs(path)
+            except OSError:
+                pass
 
-        np.savez_compressed(path + "bs", **self.hist)
+        self.hist.save(path + "bs", self.history_writer)
         if self.plots:
-            self.plot_metrics()
+            if self.plot_queue is not None:
+                plot_path = "./hist/{}/trial{}/".format(self.bs_name, self.trial_number)
+                self.plot_queue.submit(
+                    Basestation.render_slice_metrics,
+                    [
+                        (
+                            slice.name,
+                            np.array(
+                                [
+                                    slice.no_windows_hist[label]
+                                    for label in Slice.hist_labels
+                                ]
+                            ),
+                            {
+                                label: np.array(values)
+                                for label, values in slice.aux_hist.items()
+                            },
+                        )
+                        for slice in self.slices
+                    ],
+                    plot_path,
+                )
+                self.plot_queue.submit(
+                    Basestation.render_bs_metrics,
+                    np.array(self.hist["actions"].T),
+                    np.array(self.hist["rewards"]),
+                    self.total_number_rbs,
+                    plot_path,
+                )
+            else:
+                # pyplot is not thread-safe, so the files are plotted in this
+                # thread after being written
+                if self.history_writer is not None:
+                    self.history_writer.flush()
+                self.plot_metrics()
 
     @staticmethod
     def read_hist(
@@ -588,13 +842,34 @@ class Basestation(gym.Env):
     information from external file.
     """
 
-    def plot_slice_metrics(self):
+    def plot_slice_metrics(self, trial_number: int = None):
         bs_name = self.bs_name
-        trial_number = self.trial_number
-        max_slice_id = self.slices.shape[0]
+        trial_number = self.trial_number if trial_number is None else trial_number
+        root_path = "."
+
+        Basestation.render_slice_metrics(
+            [
+                (
+                    slice.name,
+                    Slice.read_hist(bs_name, trial_number, slice.id, root_path),
+                    dict(
+                        Slice.read_aux_hist(bs_name, trial_number, slice.id, root_path)
+                    ),
+                )
+                for slice in self.slices
+            ],
+            "{}/hist/{}/trial{}/".format(root_path, bs_name, trial_number),
+        )
+
+    @staticmethod
+    def render_slice_metrics(slices_hists: list, path: str):
+        """
+        Plot the hists of all slices in pdf files, where slices_hists contains
+        the name, the hist (one row per label) and the requirements hist of
+        each slice.
+        """
         #step = self.ues.shape[0]
         step = 1
-        root_path = "."
 
         filenames = [
             "rcv_thr",
@@ -619,19 +894,17 @@ class Basestation(gym.Env):
             "Long-term Throughput Ratio (%)",
             "Fifth-percentile Throughput Ratio (%)",
         ]
+        os.makedirs(path, exist_ok=True)
         for plot_number in range(len(filenames)):
             w, h = plt.figaspect(0.6)
             fig = plt.figure(figsize=(w, h))
             plt.xlabel(x_label, fontsize=14)
             plt.ylabel(y_labels[plot_number], fontsize=14)
             plt.grid()
-            for slice in self.slices:
-                hist = Slice.read_hist(bs_name, trial_number, slice.id, root_path)[
-                    plot_number
-                ]
+            for slice_name, slice_hist, aux_hist in slices_hists:
+                hist = slice_hist[plot_number]
                 if plot_number in [2,4,5,7,8]:
-                    aux_hist = Slice.read_aux_hist(bs_name, trial_number, slice.id, root_path)
-                    if slice.name == "embb" or slice.name == "urllc":
+                    if slice_name == "embb" or slice_name == "urllc":
                         if filenames[plot_number] == "pkt_thr_capacity":
                             hist = 100 * hist/(aux_hist["throughput"] * 1e3)
                         elif filenames[plot_number] == "avg_buffer_lat":
@@ -640,7 +913,7 @@ class Basestation(gym.Env):
                             hist = 100 * hist/aux_hist["pkt_loss"]
                         else:
                             continue
-                    elif slice.name == "be":
+                    elif slice_name == "be":
                         if filenames[plot_number] == "long_term_pkt_thr":
                             hist = 100 * hist/(aux_hist["long_term_pkt_thr"] * 1e3)
                         elif filenames[plot_number] == "fifth_perc_pkt_thr":
@@ -650,14 +923,12 @@ class Basestation(gym.Env):
                 plt.plot(
                     range(0, len(hist), step),
                     hist[0::step],
-                    label="Slice {}".format(slice.name),
+                    label="Slice {}".format(slice_name),
                 )
             fig.tight_layout()
             plt.legend(fontsize=12)
             fig.savefig(
-                "{}/hist/{}/trial{}/{}.pdf".format(
-                    root_path, bs_name, trial_number, filenames[plot_number]
-                ),
+                "{}{}.pdf".format(path, filenames[plot_number]),
                 # bbox_inches="tight",
                 pad_inches=0,
                 format="pdf",
@@ -666,13 +937,28 @@ class Basestation(gym.Env):
             # plt.show()
             plt.close()
 
-    def plot_bs_metrics(self):
+    def plot_bs_metrics(self, trial_number: int = None):
         bs_name = self.bs_name
-        trial_number = self.trial_number
-        max_slice_id = self.slices.shape[0]
+        trial_number = self.trial_number if trial_number is None else trial_number
+        root_path = "."
+
+        Basestation.render_bs_metrics(
+            *Basestation.read_hist(bs_name, trial_number, root_path),
+            self.total_number_rbs,
+            "{}/hist/{}/trial{}/".format(root_path, bs_name, trial_number),
+        )
+
+    @staticmethod
+    def render_bs_metrics(
+        actions: np.array, rewards: np.array, total_number_rbs: int, path: str
+    ):
+        """
+        Plot the RBs allocated to each slice (one row per slice) and the
+        rewards in pdf files.
+        """
+        max_slice_id = actions.shape[0]
         #step = self.ues.shape[0]
         step = 1
-        root_path = "."
         
         filenames = [
             "rbs_allocation",
@@ -684,18 +970,17 @@ class Basestation(gym.Env):
             "Reward",
         ]
         total = [
-            self.total_number_rbs,
+            total_number_rbs,
             1
         ]
         slices_name = ["BE", "eMBB", "URLLC"]
+        os.makedirs(path, exist_ok=True)
         for plot_number in range(len(filenames)):
             w, h = plt.figaspect(0.6)
             fig = plt.figure(figsize=(w, h))
             plt.xlabel(x_label, fontsize=14)
             plt.ylabel(y_labels[plot_number], fontsize=14)
-            hist = Basestation.read_hist(bs_name, trial_number, root_path)[
-                plot_number
-            ]
+            hist = (actions, rewards)[plot_number]
             hist = hist/total[plot_number]
             if y_labels[plot_number] == "Resource Blocks Ratio (%)":
                 for slice_id in range(0, max_slice_id):
@@ -722,9 +1007,7 @@ class Basestation(gym.Env):
             fig.tight_layout()
             plt.grid()
             fig.savefig(
-                "{}/hist/{}/trial{}/{}.pdf".format(
-                    root_path, bs_name, trial_number, filenames[plot_number]
-                ),
+                "{}{}.pdf".format(path, filenames[plot_number]),
                 bbox_inches="tight",
                 pad_inches=0,
                 format="pdf",
@@ -733,9 +1016,9 @@ class Basestation(gym.Env):
             # plt.show()
             plt.close()
 
-    def plot_metrics(self) -> None:
-        self.plot_slice_metrics()
-        self.plot_bs_metrics()
+    def plot_metrics(self, trial_number: int = None) -> None:
+        self.plot_slice_metrics(trial_number)
+        self.plot_bs_metrics(trial_number)
 
     @staticmethod
     def packets_to_mbps(packet_size, number_packets):
@@ -0,0 +1,412 @@
+import numpy as np
+from gymnasium.vector import VectorEnv
+from gymnasium.vector.utils import batch_space
+
+try:
+    from gymnasium.vector import AutoresetMode
+
+    SAME_STEP_AUTORESET = AutoresetMode.SAME_STEP
+except ImportError:  # gymnasium < 1.0 (pinned by stable-baselines3 2.1)
+    SAME_STEP_AUTORESET = "SameStep"
+
+from basestation import Basestation
+from buffer import BufferBank
+from scheduler import Scheduler
+from ue import UE
+from window import SlidingWindow
+
+
+class BatchedBasestation(VectorEnv):
+    """
+    Vector environment containing several independent basestations (cells)
+    with the same configuration, following the gymnasium.vector interface.
+    Instead of stepping each Basestation object, the state of all cells is
+    stored in stacked arrays (one row per UE of every cell, grouped by cell and
+    then by slice): buffers in a single BufferBank, windows, SE values and
+    traffic. Each step allocates the RBs, sends and receives the packets and
+    calculates the observations and rewards of all cells with array operations,
+    reproducing the Basestation.step() results of each cell.
+
+    The Basestation objects of each cell (self.cells) are kept to reset the
+    trials and update the traffics and requirements, which happen only a few
+    times per episode. Each cell uses its own random generator as a
+    Basestation would do. All cells step and finish their episodes together,
+    so they are automatically reset in the same step (the final observations
+    are returned in the info "final_obs" key). Hists are not recorded.
+    """
+
+    metadata = {"autoreset_mode": SAME_STEP_AUTORESET}
+
+    def __init__(
+        self,
+        number_envs: int,
+        seed: int = None,
+        rngs: list = None,
+        **basestation_args,
+    ) -> None:
+        if "rng" in basestation_args:
+            raise Exception("Use rngs to give the random generator of each cell")
+        for arg in [
+            "save_hist",
+            "plots",
+            "slice_plots",
+            "ue_plots",
+            "precompute_traffic",
+        ]:
+            if basestation_args.get(arg, False):
+                raise Exception("BatchedBasestation does not support {}".format(arg))
+        # The batch draws its own arrivals, so frozen traces would be ignored
+        if basestation_args.get("traffic_schedules") is not None:
+            raise Exception("BatchedBasestation does not support traffic_schedules")
+        if basestation_args.get("history_level", "off") != "off":
+            raise Exception("BatchedBasestation does not record hists")
+        basestation_args["history_level"] = "off"
+        basestation_args["record_aux_hist"] = False
+        rngs = (
+            [
+                np.random.default_rng(seed_sequence)
+                for seed_sequence in np.random.SeedSequence(seed).spawn(number_envs)
+            ]
+            if rngs is None
+            else rngs
+        )
+        if len(rngs) != number_envs:
+            raise Exception(
+                "{} random generators received for {} cells".format(
+                    len(rngs), number_envs
+                )
+            )
+        self.cells = [Basestation(rng=rng, **basestation_args) for rng in rngs]
+        cell = self.cells[0]
+        ue = cell.ues[0]
+
+        self.num_envs = number_envs
+        self.closed = False
+        self.single_observation_space = cell.observation_space
+        self.single_action_space = cell.action_space
+        self.observation_space = batch_space(cell.observation_space, number_envs)
+        self.action_space = batch_space(cell.action_space, number_envs)
+
+        self.max_number_steps = cell.max_number_steps
+        self.steps_update_traffics = cell.steps_update_traffics
+        self.total_number_rbs = cell.total_number_rbs
+        self.action_projection = cell.action_projection
+        self.action_space_options = cell.action_space_options
+        self.obs_space_mode = cell.obs_space_mode
+        self.obs_fields = cell.obs_fields
+
+        # UE parameters (the same for all UEs)
+        self.packet_size = ue.packet_size
+        self.ue_bandwidth = ue.bandwidth
+        self.ue_total_number_rbs = ue.total_number_rbs
+        self.se_gain = ue.se_gain
+        self.normalize_factors = np.array(
+            [100, 100, 100, 1, ue.buffer_max_lat, 1, 100, 100, 100]
+            if ue.normalize_obs
+            else np.ones(len(ue.hist_labels))
+        )
+
+        # UEs are grouped by slice inside each cell
+        self.number_slices = cell.slices.shape[0]
+        self.number_ues = cell.ues.shape[0]
+        self.number_rows = number_envs * self.number_ues
+        self.slice_sizes = np.array([len(slice.ues) for slice in cell.slices])
+        self.slice_starts = np.concatenate(([0], np.cumsum(self.slice_sizes)[:-1]))
+        self.ue_slices = np.repeat(np.arange(self.number_slices), self.slice_sizes)
+
+        self.buffer_bank = BufferBank(
+            self.number_rows, cell.max_packets_buffer, cell.buffer_max_lat
+        )
+        self.pkt_received = np.zeros(self.number_rows)
+        self.partial_sent_pkts = np.zeros(self.number_rows)
+        self.traffic_throughputs = np.zeros(self.number_rows)
+        self.se = np.zeros((self.number_rows, ue.se.shape[0]))
+        self.pkt_loss_window = SlidingWindow(ue.windows_size - 1, (self.number_rows, 3))
+        self.pkt_thr_window = SlidingWindow(ue.windows_size, (self.number_rows,))
+        self.obs_window = SlidingWindow(
+            ue.windows_size_obs, (self.number_rows, len(ue.hist_labels))
+        )
+        self.ues_hist = np.zeros(
+            (number_envs, self.number_ues, len(ue.hist_labels)), dtype=np.float32
+        )
+        self.slices_hist = np.zeros(
+            (number_envs, self.number_slices, len(ue.hist_labels)), dtype=np.float32
+        )
+        self.slices_no_windows_hist = np.zeros_like(self.slices_hist)
+        self.scheduler = Scheduler.create(
+            cell.scheduler, self.slice_sizes, (number_envs,)
+        )
+        self.obs = np.zeros(self.observation_space.shape, dtype=np.float32)
+        self.step_number = 0
+
+    def reset(self, *, seed: int = None, options: dict = None):
+        """
+        Reset all cells, starting the next trial of each one (or the
+        options["initial_trial"]). The Basestation objects of the cells are
+        reset and their initial buffers are copied to the stacked arrays. A
+        given seed reseeds the random generators of the cells, spawned from
+        it as in __init__(), so runs reset with the same seed are repeated.
+        """
+        initial_trial = (options or {}).get("initial_trial", -1)
+        if seed is not None:
+            # Reseeded in place, since the UEs keep the generator of the cell
+            for cell, seed_sequence in zip(
+                self.cells, np.random.SeedSequence(seed).spawn(self.num_envs)
+            ):
+                cell.rng.bit_generator.state = type(cell.rng.bit_generator)(
+                    seed_sequence
+                ).state
+        for n, cell in enumerate(self.cells):
+            cell.step_number = self.step_number
+            cell.reset(initial_trial)
+            rows = slice(n * self.number_ues, (n + 1) * self.number_ues)
+            for name in [
+                "ring",
+                "head",
+                "n_pkts",
+                "cumulative_buffer",
+                "dropped_packets",
+                "sent_packets",
+            ]:
+                getattr(self.buffer_bank, name)[rows] = getattr(cell.buffer_bank, name)
+            ues = [ue for slice in cell.slices for ue in slice.ues]
+            self.pkt_received[rows] = [ue.pkt_received for ue in ues]
+            self.se[rows] = [ue.se for ue in ues]
+        self.update_traffics()
+        self.partial_sent_pkts[:] = 0
+        for window in [self.pkt_loss_window, self.pkt_thr_window, self.obs_window]:
+            window.reset()
+        self.ues_hist[:] = 0
+        self.slices_hist[:] = 0
+        self.slices_no_windows_hist[:] = 0
+        self.scheduler.reset()
+        self.step_number = 0
+
+        # Copied, since the obs buffer is overwritten in the next steps
+        return (self.get_obs_space().copy(), {})
+
+    def step(self, actions: np.array):
+        """
+        Perform one step in all cells, where actions contains one row per cell.
+        """
+        rbs_allocation = self.get_rbs_allocation(np.asarray(actions))
+        rbs_ues = (
+            self.scheduler.allocate(
+                rbs_allocation,
+                (self.se_gain * self.se[:, self.step_number]).reshape(
+                    self.num_envs, self.number_ues
+                ),
+            )
+            .reshape(-1)
+            .astype(float)
+        )
+
+        # Packets sent by each UE
+        capacity = (
+            (rbs_ues / self.ue_total_number_rbs)
+            * self.ue_bandwidth
+            * (self.se_gain * self.se[:, self.step_number])
+            / 1e3
+        )
+        pkts = (self.partial_sent_pkts + capacity) / self.packet_size
+        pkt_throughputs = np.floor(pkts)
+        self.partial_sent_pkts = np.where(
+            self.buffer_bank.n_pkts > pkt_throughputs, pkts - pkt_throughputs, 0
+        )
+        real_served_thr = self.partial_sent_pkts + capacity
+        self.buffer_bank.send_packets(pkt_throughputs)
+        self.update_hist(real_served_thr)
+
+        # Packets received for the next step, where each cell draws the packets
+        # of its UEs in the slices order, as they are stepped in Basestation
+        self.pkt_received[:] = 0
+        active = self.traffic_throughputs != -1
+        packets_rate = (self.traffic_throughputs * 1e3) / self.packet_size
+        for n, cell in enumerate(self.cells):
+            rows = slice(n * self.number_ues, (n + 1) * self.number_ues)
+            cell_pkt_received = self.pkt_received[rows]
+            cell_active = active[rows]
+            cell_pkt_received[cell_active] = cell.rng.poisson(
+                packets_rate[rows][cell_active]
+            )
+        self.buffer_bank.receive_packets(self.pkt_received)
+
+        rewards = self.calculate_reward()
+        self.step_number += 1
+        if self.step_number % self.steps_update_traffics == 0:
+            for cell in self.cells:
+                cell.update_ues_traffic()
+            self.update_traffics()
+
+        terminations = np.full(self.num_envs, self.step_number == self.max_number_steps)
+        truncations = np.zeros(self.num_envs, dtype=bool)
+        infos = {}
+        obs = self.get_obs_space().copy()
+        if terminations[0]:
+            infos["final_obs"] = np.empty(self.num_envs, dtype=object)
+            for n in range(self.num_envs):
+                infos["final_obs"][n] = obs[n]
+            infos["_final_obs"] = terminations.copy()
+            obs, _ = self.reset()
+
+        return (obs, rewards, terminations, truncations, infos)
+
+    def get_rbs_allocation(self, actions: np.array) -> np.array:
+        """
+        Convert the action of each cell into the number of RBs of each slice,
+        following the action projection of the cells (see Basestation.step()).
+        """
+        sums = np.sum(actions + 1, axis=1, keepdims=True)
+        rbs_allocation = np.where(
+            sums != 0,
+            ((actions + 1) / np.where(sums != 0, sums, 1)) * self.total_number_rbs,
+            np.ones(actions.shape) * (1 / actions.shape[1]) * self.total_number_rbs,
+        )
+        if self.action_projection == "direct":
+            return Basestation.project_action(rbs_allocation, self.total_number_rbs)
+        action_idx = np.argmin(
+            np.sum(
+                np.abs(
+                    self.action_space_options[np.newaxis]
+                    - rbs_allocation[:, np.newaxis]
+                ),
+                axis=2,
+            ),
+            axis=1,
+        )
+        return self.action_space_options[action_idx]
+
+    def update_hist(self, real_served_thr: np.array) -> None:
+        """
+        Update the last hist values of UEs and slices following UE.update_hist()
+        and Slice.update_hist().
+        """
+        n_pkts = self.buffer_bank.n_pkts
+        sent_packets = self.buffer_bank.sent_packets
+        dropped_packets = self.buffer_bank.dropped_packets
+        self.pkt_loss_window.push(
+            np.stack((self.pkt_received, sent_packets, dropped_packets), axis=1)
+        )
+        window_rcv, window_snt, window_loss = self.pkt_loss_window.sum().T
+        window_rcv = UE.packets_to_mbps(self.packet_size, window_rcv)
+        window_snt = UE.packets_to_mbps(self.packet_size, window_snt)
+        pkt_rcv = UE.packets_to_mbps(self.packet_size, self.pkt_received)
+        buffer_pkts = n_pkts + window_snt + window_loss - window_rcv
+        den = window_rcv + pkt_rcv + buffer_pkts
+        pkt_thr = UE.packets_to_mbps(self.packet_size, real_served_thr)
+        self.pkt_thr_window.push(pkt_thr)
+        hist_vars = np.stack(
+            (
+                pkt_rcv,
+                UE.packets_to_mbps(self.packet_size, sent_packets),
+                pkt_thr,
+                n_pkts / self.buffer_bank.max_packets_buffer,
+                self.buffer_bank.get_avg_delay(),
+                np.divide(
+                    window_loss + dropped_packets,
+                    den,
+                    out=np.zeros(self.number_rows),
+                    where=den != 0,
+                ),
+                self.se_gain * self.se[:, self.step_number],
+                self.pkt_thr_window.mean(),
+                self.pkt_thr_window.percentile(5),
+            ),
+            axis=1,
+        )
+        self.obs_window.push(hist_vars)
+        self.ues_hist[:] = (self.obs_window.mean() / self.normalize_factors).reshape(
+            self.ues_hist.shape
+        )
+
+        # Slices hist are the average of their UEs hist
+        ues_no_windows_hist = hist_vars.astype(np.float32).reshape(self.ues_hist.shape)
+        for i, (start, size) in enumerate(zip(self.slice_starts, self.slice_sizes)):
+            self.slices_hist[:, i] = (
+                np.add.reduce(self.ues_hist[:, start : start + size], axis=1) / size
+            )
+            self.slices_no_windows_hist[:, i] = (
+                np.add.reduce(ues_no_windows_hist[:, start : start + size], axis=1)
+                / size
+            )
+
+    def update_traffics(self) -> None:
+        """
+        Copy the UE traffics, the slice requirements and the compiled rewards of
+        the cells after they are updated.
+        """
+        for n, cell in enumerate(self.cells):
+            rows = slice(n * self.number_ues, (n + 1) * self.number_ues)
+            self.traffic_throughputs[rows] = [
+                ue.traffic_throughput for slice in cell.slices for ue in slice.ues
+            ]
+            self.obs[n, self.obs_fields["requirements"]] = cell.obs_requirements
+        self.rewards_terms = {
+            name: np.array([getattr(cell.reward_function, name) for cell in self.cells])
+            for name in [
+                "linear_indexes",
+                "linear_weights",
+                "exp_indexes",
+                "exp_weights",
+                "penalty_indexes",
+                "penalty_weights",
+                "penalty_thresholds",
+                "penalty_signs",
+                "penalty_scales",
+            ]
+        }
+
+    def calculate_reward(self) -> np.array:
+        """
+        Calculate the reward of all cells at once using the reward terms
+        compiled by each cell (see Reward.calculate()).
+        """
+        terms = self.rewards_terms
+        values = self.slices_no_windows_hist.reshape(self.num_envs, -1).astype(
+            np.float64
+        )
+
+        return (
+            np.sum(
+                terms["linear_weights"]
+                * np.take_along_axis(values, terms["linear_indexes"], axis=1),
+                axis=1,
+            )
+            + np.sum(
+                terms["exp_weights"]
+                * np.exp(-np.take_along_axis(values, terms["exp_indexes"], axis=1)),
+                axis=1,
+            )
+            - np.sum(
+                terms["penalty_weights"]
+                * np.maximum(
+                    terms["penalty_signs"]
+                    * (
+                        terms["penalty_thresholds"]
+                        - np.take_along_axis(values, terms["penalty_indexes"], axis=1)
+                    ),
+                    0,
+                )
+                / terms["penalty_scales"],
+                axis=1,
+            )
+        )
+
+    def get_obs_space(self) -> np.array:
+        """
+        Get the observation of all cells, one per row, following the layout of
+        Basestation.get_obs_space(). The returned array is overwritten in the
+        next steps.
+        """
+        self.obs[:, self.obs_fields["slices"]] = self.slices_hist.reshape(
+            self.num_envs, -1
+        )
+        if self.obs_space_mode == "full":
+            self.obs[:, self.obs_fields["ues"]] = self.ues_hist.reshape(
+                self.num_envs, -1
+            )
+
+        return self.obs
+
+    def close_extras(self, **kwargs) -> None:
+        pass
@@ -9,13 +9,34 @@ class Buffer:
     """
 
     def __init__(self, max_packets_buffer: int, max_packet_age: int) -> None:
-        self.buffer = np.zeros(max_packet_age + 1)
+        self.ring = np.zeros(max_packet_age + 1)
+        self.head = 0  # ring position of the packets that arrived in this step
+        self.n_pkts = 0  # number of packets in the buffer
         self.cumulative_buffer = np.zeros(max_packet_age + 1)
         self.max_packets_buffer = max_packets_buffer
         self.max_packets_age = max_packet_age
         self.dropped_packets = 0  # number of dropped packets per step
         self.sent_packets = 0  # number of sent packets per step
 
+    def reset(self) -> None:
+        """
+        Remove all packets and statistics keeping the allocated arrays.
+        """
+        self.ring[:] = 0
+        self.head = 0
+        self.n_pkts = 0
+        self.cumulative_buffer[:] = 0
+        self.dropped_packets = 0
+        self.sent_packets = 0
+
+    @property
+    def buffer(self) -> np.array:
+        """
+        Return the buffer ordered by the packets age, where the index 0 represents
+        the packets that arrived now.
+        """
+        return np.roll(self.ring, -self.head)
+
     def receive_packets(self, num_packets_arrived: int) -> None:
         """
         Add the arrived packets to the buffer structure. The buffer is represented
@@ -23,42 +44,73 @@ class Buffer:
         and the last index n represents the packets which are waiting n steps to be
         transmitted. A packet is dropped when it stays for more than max_packet_age
         steps or when the num_packets_arrived is greater than the buffer space
-        available (depends on max_packets_buffer).
+        available (depends on max_packets_buffer). The array is stored as a ring
+        starting at self.head, so aging the packets only moves the head back and
+        reuses the position of the oldest packets for the arrived ones.
         """
-        self.dropped_packets = 0
-        self.dropped_packets += self.buffer[-1]
-        self.buffer = np.roll(self.buffer, 1)
-        self.buffer[0] = 0
-        if (np.sum(self.buffer) + num_packets_arrived) <= self.max_packets_buffer:
-            self.buffer[0] = num_packets_arrived
-        else:
-            self.dropped_packets += num_packets_arrived - (
-                self.max_packets_buffer - np.sum(self.buffer)
-            )
-            self.buffer[0] = self.max_packets_buffer - np.sum(self.buffer)
+        self.head = (self.head - 1) % self.ring.shape[0]
+        self.dropped_packets = self.ring[self.head]
+        self.n_pkts -= self.dropped_packets
+        accepted_packets = min(
+            num_packets_arrived, self.max_packets_buffer - self.n_pkts
+        )
+        self.dropped_packets += num_packets_arrived - accepted_packets
+        self.ring[self.head] = accepted_packets
+        self.n_pkts += accepted_packets
 
     def send_packets(self, packets_available_to_send: int) -> None:
         """
         Transmit packets from buffer to free buffer space. It allocates the packets
         waiting longer time (near from last array element) first.
         """
-        tmp_buffer = self.buffer.copy()
-        if (self.get_buffer_occupancy() != 0) or (packets_available_to_send != 0):
-            for i in np.arange(self.buffer.shape[0])[::-1]:
-                if packets_available_to_send >= self.buffer[i]:
-                    packets_available_to_send -= self.buffer[i]
-                    self.buffer[i] = 0
-                else:
-                    self.buffer[i] -= packets_available_to_send
-                    break
-        self.cumulative_buffer += tmp_buffer - self.buffer
-        self.sent_packets = np.sum(tmp_buffer) - np.sum(self.buffer)
+        sent = Buffer.drain_fifo(
+            self.buffer[np.newaxis, :], np.array([packets_available_to_send])
+        )[0]
+        self.ring -= np.roll(sent, self.head)
+        self.cumulative_buffer += sent
+        self.sent_packets = min(packets_available_to_send, self.n_pkts)
+        self.n_pkts -= self.sent_packets
+
+    @staticmethod
+    def drain_fifo(buffers: np.array, packets_available_to_send: np.array) -> np.array:
+        """
+        Return the number of packets sent from each age bin of a 2-D array with one
+        buffer ordered by packet age per row, where packets_available_to_send has
+        one value per row. The cumulative sum from the oldest bin gives the
+        cut-off bin of each row using a single searchsorted call: older bins are
+        sent entirely and the cut-off bin sends only the remaining packets.
+        """
+        number_rows, number_bins = buffers.shape
+        reversed_buffers = buffers[:, ::-1]
+        waiting_packets = np.cumsum(reversed_buffers, axis=1)
+        total_packets = waiting_packets[:, -1]
+        budgets = np.minimum(packets_available_to_send, total_packets)
+
+        # Offsetting each row keeps the flattened array sorted
+        offsets = np.arange(number_rows) * (np.max(total_packets, initial=0) + 1)
+        cut_off = (
+            np.searchsorted(
+                (waiting_packets + offsets[:, np.newaxis]).ravel(),
+                budgets + offsets,
+                side="right",
+            )
+            - np.arange(number_rows) * number_bins
+        )
+
+        sent = np.where(
+            np.arange(number_bins) < cut_off[:, np.newaxis], reversed_buffers, 0
+        )
+        rows = np.flatnonzero(cut_off < number_bins)
+        sent[rows, cut_off[rows]] = budgets[rows] - (
+            waiting_packets[rows, cut_off[rows]] - reversed_buffers[rows, cut_off[rows]]
+        )
+        return sent[:, ::-1]
 
     def get_buffer_n_pkts(self) -> int:
         """
         Return the number of packets in the buffer.
         """
-        return np.sum(self.buffer) 
+        return self.n_pkts
     
     def get_buffer_occupancy(self) -> np.array:
         """
@@ -80,6 +132,199 @@ class Buffer:
             return 0
 
 
+class BufferBank:
+    """
+    Class containing the buffers of a group of UEs stored as a single 2-D array
+    with shape (number_buffers, max_packet_age + 1), where each row follows the
+    same structure of the Buffer class. Packets are received, aged, dropped and
+    sent for all UEs at once. Slices and UEs use views of the rows that belong to
+    them (see view() and get_buffer()), so any change made through a view is
+    seen by the whole bank.
+    """
+
+    def __init__(
+        self, number_buffers: int, max_packets_buffer: int, max_packet_age: int
+    ) -> None:
+        self.ring = np.zeros((number_buffers, max_packet_age + 1))
+        self.head = np.zeros(number_buffers, dtype=int)  # ring position of age 0
+        self.n_pkts = np.zeros(number_buffers)  # number of packets per buffer
+        self.cumulative_buffer = np.zeros((number_buffers, max_packet_age + 1))
+        self.max_packets_buffer = max_packets_buffer
+        self.max_packets_age = max_packet_age
+        self.dropped_packets = np.zeros(number_buffers)  # per buffer and step
+        self.sent_packets = np.zeros(number_buffers)  # per buffer and step
+
+    @staticmethod
+    def from_buffers(buffers: list) -> "BufferBank":
+        """
+        Create a bank containing a copy of the state of the buffers received.
+        """
+        bank = BufferBank(
+            len(buffers), buffers[0].max_packets_buffer, buffers[0].max_packets_age
+        )
+        for i, buffer in enumerate(buffers):
+            bank.ring[i] = buffer.buffer
+            bank.n_pkts[i] = buffer.get_buffer_n_pkts()
+            bank.cumulative_buffer[i] = buffer.cumulative_buffer
+            bank.dropped_packets[i] = buffer.dropped_packets
+            bank.sent_packets[i] = buffer.sent_packets
+        return bank
+
+    def view(self, start: int, stop: int) -> "BufferBank":
+        """
+        Return a bank sharing the memory of the rows in [start, stop).
+        """
+        bank = object.__new__(BufferBank)
+        bank.ring = self.ring[start:stop]
+        bank.head = self.head[start:stop]
+        bank.n_pkts = self.n_pkts[start:stop]
+        bank.cumulative_buffer = self.cumulative_buffer[start:stop]
+        bank.max_packets_buffer = self.max_packets_buffer
+        bank.max_packets_age = self.max_packets_age
+        bank.dropped_packets = self.dropped_packets[start:stop]
+        bank.sent_packets = self.sent_packets[start:stop]
+        return bank
+
+    def get_buffer(self, index: int) -> "BufferView":
+        """
+        Return the buffer of a single UE as a view of the bank row.
+        """
+        return BufferView(self, index)
+
+    def reset(self) -> None:
+        """
+        Remove all packets and statistics of the bank rows in place, so views
+        of the bank are also reset.
+        """
+        self.ring[:] = 0
+        self.head[:] = 0
+        self.n_pkts[:] = 0
+        self.cumulative_buffer[:] = 0
+        self.dropped_packets[:] = 0
+        self.sent_packets[:] = 0
+
+    def get_ring_positions(self) -> np.array:
+        """
+        Return the ring position of each packet age for every buffer.
+        """
+        return (
+            self.head[:, np.newaxis] + np.arange(self.ring.shape[1])
+        ) % self.ring.shape[1]
+
+    @property
+    def buffer(self) -> np.array:
+        """
+        Return a copy of the buffers ordered by the packets age, where the column
+        0 represents the packets that arrived now.
+        """
+        return np.take_along_axis(self.ring, self.get_ring_positions(), axis=1)
+
+    def receive_packets(self, num_packets_arrived: np.array) -> None:
+        """
+        Add the arrived packets to all buffers following the same rules of
+        Buffer.receive_packets(), where num_packets_arrived contains one value
+        per buffer.
+        """
+        rows = np.arange(self.ring.shape[0])
+        self.head[:] = (self.head - 1) % self.ring.shape[1]
+        self.dropped_packets[:] = self.ring[rows, self.head]
+        self.n_pkts -= self.dropped_packets
+        accepted_packets = np.minimum(
+            num_packets_arrived, self.max_packets_buffer - self.n_pkts
+        )
+        self.dropped_packets += num_packets_arrived - accepted_packets
+        self.ring[rows, self.head] = accepted_packets
+        self.n_pkts += accepted_packets
+
+    def send_packets(self, packets_available_to_send: np.array) -> None:
+        """
+        Transmit packets from all buffers following the FIFO logic of
+        Buffer.send_packets(), where packets_available_to_send contains one value
+        per buffer (see Buffer.drain_fifo()).
+        """
+        positions = self.get_ring_positions()
+        sent = Buffer.drain_fifo(
+            np.take_along_axis(self.ring, positions, axis=1),
+            packets_available_to_send,
+        )
+        self.ring[np.arange(self.ring.shape[0])[:, np.newaxis], positions] -= sent
+        self.cumulative_buffer += sent
+        self.sent_packets[:] = np.minimum(packets_available_to_send, self.n_pkts)
+        self.n_pkts -= self.sent_packets
+
+    def get_buffer_n_pkts(self) -> np.array:
+        """
+        Return the number of packets in each buffer.
+        """
+        return self.n_pkts.copy()
+
+    def get_buffer_occupancy(self) -> np.array:
+        """
+        Return the buffer occupancy rate of each buffer.
+        """
+        return self.get_buffer_n_pkts() / self.max_packets_buffer
+
+    def get_avg_delay(self) -> np.array:
+        """
+        Return the average time that the transmitted packets waited in each
+        buffer, following Buffer.get_avg_delay().
+        """
+        total_packets = np.sum(self.cumulative_buffer, axis=1)
+        return np.divide(
+            self.cumulative_buffer @ np.arange(self.max_packets_age + 1),
+            total_packets,
+            out=np.zeros(total_packets.shape[0]),
+            where=total_packets != 0,
+        )
+
+
+class BufferView:
+    """
+    Buffer of a single UE stored as one row of a BufferBank. It has the same
+    interface of the Buffer class, so the UE does not need to know that its
+    buffer is shared with the other UEs of the basestation.
+    """
+
+    def __init__(self, bank: BufferBank, index: int) -> None:
+        self.bank = bank.view(index, index + 1)
+        self.max_packets_buffer = bank.max_packets_buffer
+        self.max_packets_age = bank.max_packets_age
+
+    @property
+    def buffer(self) -> np.array:
+        return self.bank.buffer[0]
+
+    @property
+    def cumulative_buffer(self) -> np.array:
+        return self.bank.cumulative_buffer[0]
+
+    @property
+    def dropped_packets(self) -> float:
+        return self.bank.dropped_packets[0]
+
+    @property
+    def sent_packets(self) -> float:
+        return self.bank.sent_packets[0]
+
+    def reset(self) -> None:
+        self.bank.reset()
+
+    def receive_packets(self, num_packets_arrived: int) -> None:
+        self.bank.receive_packets(np.array([num_packets_arrived]))
+
+    def send_packets(self, packets_available_to_send: int) -> None:
+        self.bank.send_packets(np.array([packets_available_to_send]))
+
+    def get_buffer_n_pkts(self) -> int:
+        return self.bank.get_buffer_n_pkts()[0]
+
+    def get_buffer_occupancy(self) -> float:
+        return self.bank.get_buffer_occupancy()[0]
+
+    def get_avg_delay(self) -> float:
+        return self.bank.get_avg_delay()[0]
+
+
 def main():
     # Testing Buffer functions
     arrived_packets = [0, 10, 0, 5, 2, 2, 10, 15, 20, 10]
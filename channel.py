@@ -1,5 +1,7 @@
+import multiprocessing
 import os
 import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from typing import Tuple
 
 import matplotlib.pyplot as plt
@@ -10,9 +12,27 @@ import pandas as pd
 class Channel:
     """
     Class containing the functions to calculate the SE for each UE in according
-    to data obtained from QuaDriGa simulations.
+    to data obtained from QuaDriGa simulations. The SE values of all trials,
+    frequencies and UEs are kept in a single file (SE store) that is
+    memory-mapped once per process, so UEs read their values without copies.
     """
 
+    se_stores = {}  # SE stores opened in this process
+    se_store_file = "se_store.npy"  # (trial, frequency, UE, sample) array
+    se_index_file = "se_store_index.npz"  # Trials, frequencies and UEs numbers
+    se_manifest_file = "se_store_manifest.txt"  # Trials written by ingest
+    # Synthetic channel: frequency (GHz), SE factor and SINR without path loss
+    # (dB) of each frequency index, calibrated to the SE statistics of the
+    # recorded trials, UE distances (m), shadowing standard deviation (dB),
+    # Rician K-factor (linear) and AR(1) coefficients of shadowing and fading
+    # per sample
+    synthetic_carriers = {1: (2, 1, 96), 2: (28, 8, 93)}
+    synthetic_distances = (60, 150)
+    synthetic_shadowing_std = 4
+    synthetic_rician_factor = 10
+    synthetic_shadowing_coefficient = 0.999
+    synthetic_fading_coefficient = 0.995
+
     @staticmethod
     def extract_power(
         path_to_rsrp_csv: str, no_cell: int, no_samples: int
@@ -22,19 +42,23 @@ class Channel:
         Output is power = [no_cell, no_samples], and serving_pci = [no_samples].
         Assumes that besides the 7 strongest cells, the remaining are effectively 0.
         """
-        one_rsrp = pd.read_csv(path_to_rsrp_csv)
+        # Only the columns used are parsed, without type inference
+        one_rsrp = pd.read_csv(
+            path_to_rsrp_csv,
+            usecols=["serving pci", "neigh 6 rsrp"],
+            dtype={"serving pci": np.int64, "neigh 6 rsrp": np.float64},
+            nrows=no_samples,
+        )
         powers = -1000 * np.ones(
             (no_cell, no_samples)
         )  # need a small starting dB value
-        serving_index = one_rsrp["serving pci"] - 1
-        for i in range(no_samples):
-            powers[serving_index[i], i] = one_rsrp["serving rsrp"][i]
+        serving_index = one_rsrp["serving pci"].to_numpy() - 1
 
-        # all powers are 0 now except for the serving ones. Now we do the same for each of the next 6, all else are effectively 0
-        for j in range(6):
-            # neigh_index = one_rsrp["neigh {} pci".format(j + 1)] - 1
-            for i in range(no_samples):
-                powers[serving_index[i], i] = one_rsrp["neigh {} rsrp".format(j + 1)][i]
+        # The serving and the next 6 powers are all written in the serving cell
+        # position (the neighbour pci is not used), so the last neighbour power
+        # is the one kept. All else are effectively 0
+        last_rsrp = one_rsrp["neigh 6 rsrp"].to_numpy()
+        powers[serving_index, np.arange(no_samples)] = last_rsrp
 
         # now all of the primary power information for that fc-UE pair is available in powers
         powers = 10 ** (powers / 10)  # convert to linear
@@ -68,10 +92,8 @@ class Channel:
             (no_fc, no_UE, no_samples), dtype=np.int16
         )  # useful for getting the best results
         if len(rho_set.shape) == 3:
-            rho_set = np.tile(
-                np.expand_dims(rho_set, -1), [1, 1, 1, no_samples]
-            )  # expand and copy to the same shape as powers
-        SIR_df = pd.read_csv(sir_path)
+            rho_set = np.expand_dims(rho_set, -1)  # broadcast to the powers shape
+        SIR_df = pd.read_csv(sir_path, nrows=0)  # Only the columns are used
 
         # get the RSRP information -- this is basically Pt * abs(H)^2, i.e. optimal precoding
         for i, col in enumerate(SIR_df.columns):
@@ -86,39 +108,18 @@ class Channel:
                                 rsrp_path + col + ".csv", no_cell, no_samples
                             )
 
-        # do something with rho_set and get SE
-        SE = np.zeros((no_fc, no_UE, no_cell, no_samples))
-        for i in range(no_fc):
-            for j in range(no_UE):
-                num = np.squeeze(rho_set[i, j, :, :]) * np.squeeze(
-                    powers[i, j, :, :]
-                )  # allows for any cell to be the serving cell
-                den = (
-                    np.sum(
-                        np.squeeze(rho_set[i, j, :, :])
-                        * np.squeeze(powers[i, j, :, :]),
-                        0,
-                    )
-                    - num
-                    + sigma_sq
-                )
-                SE[i, j, :, :] = num / den
-
-        SE = np.log2(1 + SE)
-
-        # Now, the best spectral efficiency for each UE and band is
-        serving_SE = np.zeros((no_fc, no_UE, no_samples))
-        for i in range(no_fc):
-            for j in range(no_UE):
-                for k in range(no_samples):
-                    if i == 1:
-                        serving_SE[i, j, k] = (
-                            8 * SE[i, j, np.squeeze(serving_indices[i, j, k]), k]
-                        )
-                    else:
-                        serving_SE[i, j, k] = SE[
-                            i, j, np.squeeze(serving_indices[i, j, k]), k
-                        ]
+        # do something with rho_set and get SE of the serving cells, for all
+        # carriers and UEs at once
+        received_powers = rho_set * powers  # allows for any cell to be the serving cell
+        serving_powers = np.take_along_axis(
+            received_powers, np.expand_dims(serving_indices, 2).astype(int), axis=2
+        )[:, :, 0, :]
+        serving_SE = np.log2(
+            1
+            + serving_powers
+            / (np.sum(received_powers, axis=2) - serving_powers + sigma_sq)
+        )
+        serving_SE[1:2] *= 8  # Second carrier (28 GHz)
 
         return serving_SE
 
@@ -143,6 +144,17 @@ class Channel:
         except OSError as error:
             print(error)
 
+        # The SE store is created again including the new files
+        for store_file in [
+            Channel.se_store_file,
+            Channel.se_index_file,
+            Channel.se_manifest_file,
+        ]:
+            try:
+                os.remove(os.path.join(os.path.dirname(file_path), store_file))
+            except OSError:
+                pass
+
         for trial in trials_list:
             serving_se = Channel.get_serving_se(
                 sir_path.format(trial),
@@ -174,6 +186,426 @@ class Channel:
             file_path.format(root_path, trial_number, frequency_index, ue_number)
         )
 
+    @staticmethod
+    def build_se_store(se_path: str = "./se") -> None:
+        """
+        Join the SE files written by write_se_files() into the SE store. The
+        index contains the trial, frequency and UE numbers of each position of
+        the store dimensions. Files are written with temporary names and
+        renamed, so processes starting at the same time never read partial
+        files.
+        """
+        file_pattern = re.compile(r"^trial(\d+)_f(\d+)_ue(\d+)\.npy$")
+        numbers = np.array(
+            [
+                [int(number) for number in match.groups()]
+                for match in map(file_pattern.match, sorted(os.listdir(se_path)))
+                if match is not None
+            ]
+        )
+        if numbers.shape[0] == 0:
+            raise Exception('No SE files were found in "{}"'.format(se_path))
+        trials, frequencies, ues = (np.unique(numbers[:, i]) for i in range(3))
+        number_samples = np.load(
+            "{}/trial{}_f{}_ue{}.npy".format(se_path, *numbers[0])
+        ).shape[0]
+
+        tmp_suffix = ".{}.tmp".format(os.getpid())
+        index_path = os.path.join(se_path, Channel.se_index_file)
+        store_path = os.path.join(se_path, Channel.se_store_file)
+        with open(index_path + tmp_suffix, "wb") as index_file:
+            np.savez(index_file, trials=trials, frequencies=frequencies, ues=ues)
+        os.replace(index_path + tmp_suffix, index_path)
+        store = np.lib.format.open_memmap(
+            store_path + tmp_suffix,
+            mode="w+",
+            dtype=np.float64,
+            shape=(trials.shape[0], frequencies.shape[0], ues.shape[0], number_samples),
+        )
+        store[:] = np.nan  # Missing files
+        for trial, frequency, ue in numbers:
+            store[
+                np.searchsorted(trials, trial),
+                np.searchsorted(frequencies, frequency),
+                np.searchsorted(ues, ue),
+            ] = np.load("{}/trial{}_f{}_ue{}.npy".format(se_path, trial, frequency, ue))
+        store.flush()
+        del store
+        os.replace(store_path + tmp_suffix, store_path)
+        try:
+            os.remove(os.path.join(se_path, Channel.se_manifest_file))
+        except OSError:
+            pass
+
+    @staticmethod
+    def read_se_manifest(se_path: str = "./se") -> set:
+        """
+        Return the trials written in the SE store by ingest_se_store().
+        """
+        manifest_path = os.path.join(se_path, Channel.se_manifest_file)
+        if not os.path.exists(manifest_path):
+            return set()
+        with open(manifest_path) as manifest:
+            return {int(line) for line in manifest if line.strip() != ""}
+
+    @staticmethod
+    def prepare_se_store(
+        trials_list: list,
+        no_fc: int,
+        no_UE: int,
+        no_samples: int,
+        se_path: str = "./se",
+    ) -> None:
+        """
+        Create the SE store with the given trials, frequencies and UEs, unless
+        the current store contains them. The values of the current store are
+        copied to the new one, which also keeps its trials, frequencies and
+        UEs. The manifest is restarted when the written trials would miss
+        frequencies or UEs.
+        """
+        index_path = os.path.join(se_path, Channel.se_index_file)
+        store_path = os.path.join(se_path, Channel.se_store_file)
+        manifest_path = os.path.join(se_path, Channel.se_manifest_file)
+        trials = np.unique(list(trials_list))
+        frequencies = np.arange(1, no_fc + 1)
+        ues = np.arange(1, no_UE + 1)
+        old_store = None
+        if os.path.exists(store_path) and os.path.exists(index_path):
+            index = np.load(index_path)
+            old_store = np.load(store_path, mmap_mode="r")
+            old_axes = [index["trials"], index["frequencies"], index["ues"]]
+            if old_store.shape[-1] != no_samples:
+                old_store = None
+            elif all(
+                np.all(np.isin(values, old_values))
+                for values, old_values in zip([trials, frequencies, ues], old_axes)
+            ):
+                return
+        if old_store is None or not all(
+            np.all(np.isin(values, old_values))
+            for values, old_values in zip([frequencies, ues], old_axes[1:])
+        ):
+            try:
+                os.remove(manifest_path)
+            except OSError:
+                pass
+        if old_store is not None:
+            trials, frequencies, ues = (
+                np.union1d(values, old_values)
+                for values, old_values in zip([trials, frequencies, ues], old_axes)
+            )
+
+        tmp_suffix = ".{}.tmp".format(os.getpid())
+        with open(index_path + tmp_suffix, "wb") as index_file:
+            np.savez(index_file, trials=trials, frequencies=frequencies, ues=ues)
+        store = np.lib.format.open_memmap(
+            store_path + tmp_suffix,
+            mode="w+",
+            dtype=np.float64,
+            shape=(trials.shape[0], frequencies.shape[0], ues.shape[0], no_samples),
+        )
+        store[:] = np.nan  # Trials not written yet
+        if old_store is not None:
+            store[
+                np.ix_(
+                    np.searchsorted(trials, old_axes[0]),
+                    np.searchsorted(frequencies, old_axes[1]),
+                    np.searchsorted(ues, old_axes[2]),
+                    np.arange(no_samples),
+                )
+            ] = old_store
+        store.flush()
+        del store, old_store
+        os.replace(index_path + tmp_suffix, index_path)
+        os.replace(store_path + tmp_suffix, store_path)
+
+    @staticmethod
+    def ingest_trial(
+        trial: int,
+        sir_path: str,
+        rsrp_path: str,
+        no_fc: int,
+        no_UE: int,
+        no_cell: int,
+        no_samples: int,
+        se_path: str = "./se",
+    ) -> int:
+        """
+        Calculate the SE of a trial and write it in the SE store.
+        """
+        serving_se = Channel.get_serving_se(
+            sir_path, rsrp_path, no_fc, no_UE, no_cell, no_samples
+        )
+        index = np.load(os.path.join(se_path, Channel.se_index_file))
+        store = np.load(os.path.join(se_path, Channel.se_store_file), mmap_mode="r+")
+        store[
+            np.ix_(
+                [np.searchsorted(index["trials"], trial)],
+                np.searchsorted(index["frequencies"], np.arange(1, no_fc + 1)),
+                np.searchsorted(index["ues"], np.arange(1, no_UE + 1)),
+                np.arange(no_samples),
+            )
+        ] = serving_se[np.newaxis]
+        store.flush()
+
+        return trial
+
+    @staticmethod
+    def ingest_se_store(
+        trials_list: list,
+        sir_path: str,
+        rsrp_path: str,
+        no_fc: int,
+        no_UE: int,
+        no_cell: int,
+        no_samples: int,
+        se_path: str = "./se",
+        number_workers: int = None,
+    ) -> None:
+        """
+        Calculate the SE of the trials in a pool of number_workers processes,
+        where each process writes its trials directly in the SE store (see
+        prepare_se_store()). Each trial written is appended to the manifest,
+        so the trials written by an interrupted ingest are skipped when it is
+        run again.
+        """
+        os.makedirs(se_path, exist_ok=True)
+        Channel.prepare_se_store(trials_list, no_fc, no_UE, no_samples, se_path)
+        Channel.se_stores.pop(os.path.abspath(se_path), None)
+        written_trials = Channel.read_se_manifest(se_path)
+        pending_trials = [trial for trial in trials_list if trial not in written_trials]
+        if len(pending_trials) == 0:
+            return
+
+        error = None
+        with ProcessPoolExecutor(
+            number_workers, mp_context=multiprocessing.get_context("fork")
+        ) as executor, open(
+            os.path.join(se_path, Channel.se_manifest_file), "a"
+        ) as manifest:
+            futures = [
+                executor.submit(
+                    Channel.ingest_trial,
+                    trial,
+                    sir_path.format(trial),
+                    rsrp_path.format(trial),
+                    no_fc,
+                    no_UE,
+                    no_cell,
+                    no_samples,
+                    se_path,
+                )
+                for trial in pending_trials
+            ]
+            for future in as_completed(futures):
+                if future.exception() is not None:
+                    error = future.exception() if error is None else error
+                    continue
+                manifest.write("{}\n".format(future.result()))
+                manifest.flush()
+        if error is not None:
+            raise Exception("SE ingest failed") from error
+
+    @staticmethod
+    def open_se_store(root_path: str = ".") -> dict:
+        """
+        Return the memory-mapped SE store from root_path (read-only) and the
+        positions of each trial, frequency and UE number. It is created from
+        the SE files if it does not exist and opened only once per process.
+        """
+        se_path = os.path.abspath("{}/se".format(root_path))
+        if se_path not in Channel.se_stores:
+            if not os.path.exists(os.path.join(se_path, Channel.se_store_file)):
+                Channel.build_se_store(se_path)
+            index = np.load(os.path.join(se_path, Channel.se_index_file))
+            Channel.se_stores[se_path] = {
+                "se": np.load(
+                    os.path.join(se_path, Channel.se_store_file), mmap_mode="r"
+                ),
+                "trials": {number: i for i, number in enumerate(index["trials"])},
+                "frequencies": {
+                    number: i for i, number in enumerate(index["frequencies"])
+                },
+                "ues": {number: i for i, number in enumerate(index["ues"])},
+            }
+        return Channel.se_stores[se_path]
+
+    @staticmethod
+    def get_se(
+        trial_number: int,
+        frequency_index: int,
+        ue_number: int,
+        root_path: str = ".",
+    ) -> np.array:
+        """
+        Return a read-only view of the SE values of a UE from the SE store.
+        Values missing in the store, or not written yet (NaN) by an ingest or
+        a missing SE file, are read from the UE file.
+        """
+        store = Channel.open_se_store(root_path)
+        try:
+            se = store["se"][
+                store["trials"][trial_number],
+                store["frequencies"][frequency_index],
+                store["ues"][ue_number],
+            ]
+        except KeyError:
+            se = None
+        if se is None or np.any(np.isnan(se)):
+            return Channel.read_se_file(
+                "{}/se/trial{}_f{}_ue{}.npy",
+                trial_number,
+                frequency_index,
+                ue_number,
+                root_path,
+            )
+
+        return se
+
+    @staticmethod
+    def create_se(
+        channel: str,
+        trial_number: int,
+        frequency_index: int,
+        ue_number: int,
+        number_samples: int,
+        root_path: str = ".",
+        seed: int = 0,
+    ) -> np.array:
+        """
+        Return the SE values of a UE from the channel backend:
+        - "recorded": the values of the SE store (see get_se());
+        - "trace": the recorded values reused with time offsets for any number
+          of UEs and samples (see get_se_trace());
+        - "synthetic": values generated without files (see generate_se()).
+        """
+        if channel == "recorded":
+            return Channel.get_se(trial_number, frequency_index, ue_number, root_path)
+        elif channel == "trace":
+            return Channel.get_se_trace(
+                trial_number,
+                frequency_index,
+                ue_number,
+                number_samples,
+                root_path,
+                seed,
+            )
+        elif channel == "synthetic":
+            return Channel.generate_se(
+                trial_number, frequency_index, ue_number, number_samples, seed
+            )
+        raise Exception('Channel "{}" is not valid'.format(channel))
+
+    @staticmethod
+    def get_se_trace(
+        trial_number: int,
+        frequency_index: int,
+        ue_number: int,
+        number_samples: int,
+        root_path: str = ".",
+        seed: int = 0,
+    ) -> np.array:
+        """
+        Return number_samples SE values of a UE reusing the recorded UEs of the
+        SE store, where UE number n uses the recorded UE (n - 1) % R + 1 for R
+        recorded UEs. The recorded UEs keep their values and the other UEs
+        start at a time offset drawn for each UE, repeating the trace when
+        more samples than recorded are needed.
+        """
+        recorded_ues = sorted(Channel.open_se_store(root_path)["ues"])
+        se = Channel.get_se(
+            trial_number,
+            frequency_index,
+            recorded_ues[(ue_number - 1) % len(recorded_ues)],
+            root_path,
+        )
+        offset = (
+            0
+            if ue_number <= len(recorded_ues)
+            else np.random.default_rng([seed, trial_number, ue_number]).integers(
+                se.shape[0]
+            )
+        )
+        if offset + number_samples <= se.shape[0]:
+            return se[offset : offset + number_samples]
+
+        return np.take(se, offset + np.arange(number_samples), mode="wrap")
+
+    @staticmethod
+    def generate_ar1(
+        rng: np.random.Generator,
+        coefficient: float,
+        number_samples: int,
+        number_series: int = 1,
+    ) -> np.array:
+        """
+        Return stationary AR(1) series with unit variance, with shape
+        (number_series, number_samples). The recursion is calculated in blocks
+        with cumulative sums, where the block size keeps the coefficient powers
+        in a range without precision loss.
+        """
+        state = rng.standard_normal(number_series)  # Stationary initial state
+        # Drawn sample by sample, so longer series start with the same values
+        noise = rng.standard_normal((number_samples, number_series)).T
+        if coefficient == 0:
+            return noise
+        series = np.empty_like(noise)
+        block_size = max(1, int(np.log(1e6) / -np.log(coefficient)))
+        scale = np.sqrt(1 - coefficient**2)
+        for start in range(0, number_samples, block_size):
+            block = noise[:, start : start + block_size]
+            powers = coefficient ** np.arange(block.shape[1])
+            series[:, start : start + block.shape[1]] = powers * (
+                coefficient * state[:, np.newaxis]
+                + scale * np.cumsum(block / powers, axis=1)
+            )
+            state = series[:, start + block.shape[1] - 1]
+
+        return series
+
+    @staticmethod
+    def generate_se(
+        trial_number: int,
+        frequency_index: int,
+        ue_number: int,
+        number_samples: int,
+        seed: int = 0,
+    ) -> np.array:
+        """
+        Generate the SE values of a UE, where the mean SINR follows the path
+        loss of a distance drawn for the UE (3GPP UMi LOS), with AR(1)
+        shadowing in dB and Rician fading, whose scattered part is an AR(1)
+        complex Gaussian gain.
+        The distance is drawn for each trial and UE, and the shadowing and
+        fading also for each frequency, so every UE is generated on its own
+        with the same values in any scenario and episode length.
+        """
+        frequency, se_factor, reference_sinr = Channel.synthetic_carriers[
+            frequency_index
+        ]
+        distance = np.random.default_rng([seed, trial_number, ue_number]).uniform(
+            *Channel.synthetic_distances
+        )
+        path_loss = 32.4 + 21 * np.log10(distance) + 20 * np.log10(frequency)
+        sinr = reference_sinr - path_loss
+        shadowing = Channel.synthetic_shadowing_std * Channel.generate_ar1(
+            np.random.default_rng([seed, trial_number, ue_number, frequency_index, 0]),
+            Channel.synthetic_shadowing_coefficient,
+            number_samples,
+        )
+        gain = Channel.generate_ar1(
+            np.random.default_rng([seed, trial_number, ue_number, frequency_index, 1]),
+            Channel.synthetic_fading_coefficient,
+            number_samples,
+            2,
+        )
+        rician_factor = Channel.synthetic_rician_factor
+        gain *= np.sqrt(1 / (2 * (rician_factor + 1)))
+        gain[0] += np.sqrt(rician_factor / (rician_factor + 1))  # Unit mean power
+        fading = np.sum(gain**2, axis=0)
+
+        return se_factor * np.log2(1 + 10 ** ((sinr + shadowing[0]) / 10) * fading)
+
     @staticmethod
     def plot_se(
         file_path: str,
@@ -209,13 +641,16 @@ def main():
     no_UE = 10
     no_cell = 7 * 3  # 7 base stations, each with 3 sectors
     no_samples = 1000 * 2  # 1kHz sampling for 2 seconds
-    file_path = "./se/trial{}_f{}_ue{}.npy"
-    Channel.write_se_files(
-        range(38, 51), file_path, sir_path, rsrp_path, no_fc, no_UE, no_cell, no_samples
+    # The trials are written in the SE store by parallel processes, use
+    # write_se_files() to write one file per UE instead
+    Channel.ingest_se_store(
+        range(38, 51), sir_path, rsrp_path, no_fc, no_UE, no_cell, no_samples
     )
 
     # Plot SE from trial 1 frequency index 2 from external files
-    # Channel.plot_se(file_path, 1, 1, np.arange(1, 11), no_samples)
+    # Channel.plot_se(
+    #     "./se/trial{}_f{}_ue{}.npy", 1, 1, np.arange(1, 11), no_samples
+    # )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,252 @@
+from collections.abc import Mapping
+
+import numpy as np
+
+
+class HistoryStore(Mapping):
+    """
+    Class containing the history of the variables of an entity (UE, slice or
+    basestation). The values are stored in a preallocated array with shape
+    (max_number_steps, number of columns), where each step writes one row in
+    place instead of appending to a new array. Each label uses one column
+    (or several if a width greater than 1 is given, e.g., the RBs allocated to
+    each slice). It can be used as a dict of labels, where each label returns a
+    view of the recorded steps, so it can be saved directly using
+    np.savez_compressed(path, **store).
+
+    The history level defines what is recorded besides the last step values,
+    which are always available since they compose the observation space and
+    the reward:
+    - "off": nothing else is recorded;
+    - "summary": per-episode statistics of each column (see summary());
+    - "full": the values of every decimation-th step.
+
+    In the full level, the recorded rows can be streamed to a HistoryWriter
+    in chunks during the episode (see stream()).
+    """
+
+    levels = ["off", "summary", "full"]
+
+    def __init__(
+        self,
+        labels: list,
+        max_number_steps: int,
+        widths: list = None,
+        dtype: type = np.float32,
+        level: str = "full",
+        decimation: int = 1,
+        last: np.array = None,
+    ) -> None:
+        if level not in self.levels:
+            raise Exception('History level "{}" is not valid'.format(level))
+        self.labels = list(labels)
+        self.level = level
+        self.decimation = decimation
+        widths = np.ones(len(self.labels), dtype=int) if widths is None else widths
+        limits = np.concatenate(([0], np.cumsum(widths)))
+        self.columns = {
+            label: slice(limits[i], limits[i + 1]) if widths[i] != 1 else limits[i]
+            for i, label in enumerate(self.labels)
+        }
+        self.data = np.zeros(
+            (
+                (
+                    int(np.ceil(max(max_number_steps, 1) / decimation))
+                    if level == "full"
+                    else 0
+                ),
+                limits[-1],
+            ),
+            dtype=dtype,
+        )
+        # The last step values can be written in a row of an external matrix
+        # shared by several stores (e.g., the observation of all UEs)
+        self.last = np.zeros(limits[-1], dtype=dtype) if last is None else last
+        self.summary_stats = np.zeros(
+            (4 if level == "summary" else 0, limits[-1])
+        )  # sum, squared sum, min and max
+        self.steps = 0  # number of steps appended
+        self.length = 0  # number of recorded steps
+        self.writer = None
+        self.streamed = 0  # number of recorded steps sent to the writer
+
+    def reset(self) -> None:
+        """
+        Discard the recorded steps keeping the allocated memory.
+        """
+        self.last[:] = 0
+        self.steps = 0
+        self.length = 0
+        self.streamed = 0
+
+    def stream(self, writer, path: str, chunk_size: int) -> None:
+        """
+        Send the recorded rows to the writer every chunk_size recorded steps,
+        which appends them to the file "{path}.chunks" until save() is called.
+        It must be called after reset() for each new file.
+        """
+        self.writer = writer if self.level == "full" else None
+        self.stream_path = "{}.chunks".format(path)
+        self.chunk_size = chunk_size
+        self.streamed = 0
+
+    def write_chunk(self) -> None:
+        self.writer.append_chunk(
+            self.stream_path, self.data[self.streamed : self.length], self.streamed == 0
+        )
+        self.streamed = self.length
+
+    def append(self, values: np.array) -> None:
+        """
+        Add the values of a new step, where values follow the labels order. In
+        the full level, the capacity is doubled if more steps than expected are
+        recorded.
+        """
+        self.last[:] = values
+        if self.level == "full" and self.steps % self.decimation == 0:
+            if self.length == self.data.shape[0]:
+                self.data = np.concatenate((self.data, np.zeros_like(self.data)))
+            self.data[self.length] = self.last
+            self.length += 1
+            if (
+                self.writer is not None
+                and self.length - self.streamed == self.chunk_size
+            ):
+                self.write_chunk()
+        elif self.level == "summary":
+            if self.steps == 0:
+                self.summary_stats[:2] = 0
+                self.summary_stats[2:] = self.last
+            self.summary_stats[0] += self.last
+            self.summary_stats[1] += np.square(self.last, dtype=np.float64)
+            np.minimum(self.summary_stats[2], self.last, out=self.summary_stats[2])
+            np.maximum(self.summary_stats[3], self.last, out=self.summary_stats[3])
+        self.steps += 1
+
+    def get_last(self) -> np.array:
+        """
+        Return the values of the last step (zeros if no step was added).
+        """
+        return self.last
+
+    def summary(self) -> dict:
+        """
+        Return the mean, standard deviation, minimum and maximum of each label
+        over the steps added since the last reset, using the keys
+        "{label}_{statistic}". It is available in the summary level.
+        """
+        count = max(self.steps, 1)
+        mean = self.summary_stats[0] / count
+        statistics = {
+            "mean": mean,
+            "std": np.sqrt(np.maximum(self.summary_stats[1] / count - mean**2, 0)),
+            "min": self.summary_stats[2],
+            "max": self.summary_stats[3],
+        }
+        return {
+            "{}_{}".format(label, name): values[self.columns[label]]
+            for label in self.labels
+            for name, values in statistics.items()
+        }
+
+    def to_dict(self) -> dict:
+        """
+        Return the recorded values to be saved in accordance with the history
+        level: the hist of each label for full level and the statistics for
+        summary level.
+        """
+        return self.summary() if self.level == "summary" else dict(self)
+
+    def save(self, path: str, writer=None, **arrays) -> None:
+        """
+        Save the arrays followed by the values of to_dict() in a compressed file.
+        When a writer is given, the file is saved in background, joining the
+        streamed chunks (if any) and the rows not streamed yet.
+        """
+        if writer is None:
+            np.savez_compressed(path, **arrays, **self.to_dict())
+        elif self.writer is writer and self.length > 0:
+            if self.length > self.streamed:
+                self.write_chunk()
+            writer.save(path, arrays, self.stream_path, self.columns)
+        else:
+            writer.save(path, dict(arrays, **self.to_dict()))
+
+    def __getitem__(self, label: str) -> np.array:
+        return self.data[: self.length, self.columns[label]]
+
+    def __iter__(self):
+        return iter(self.labels)
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+
+class SparseHistoryStore:
+    """
+    Class containing the history of an array per step that is mostly filled with
+    zeros, e.g., the number of packets in each age bin of a buffer. Only the
+    nonzero values are recorded, using preallocated int32 arrays containing the
+    step, the array index and the value of each of them (coordinate format).
+    The capacity is doubled when more nonzero values than expected are recorded.
+    """
+
+    def __init__(self, width: int, max_number_steps: int) -> None:
+        self.width = width
+        capacity = max(max_number_steps, 1) * 4
+        self.steps = np.zeros(capacity, dtype=np.int32)
+        self.indexes = np.zeros(capacity, dtype=np.int32)
+        self.values = np.zeros(capacity, dtype=np.int32)
+        self.number_values = 0  # number of nonzero values recorded
+        self.length = 0  # number of recorded steps
+
+    def reset(self) -> None:
+        """
+        Discard the recorded steps keeping the allocated memory.
+        """
+        self.number_values = 0
+        self.length = 0
+
+    def append(self, values: np.array) -> None:
+        """
+        Record the nonzero values of a new step.
+        """
+        indexes = np.flatnonzero(values)
+        end = self.number_values + indexes.shape[0]
+        if end > self.steps.shape[0]:
+            capacity = max(end, 2 * self.steps.shape[0])
+            for name in ["steps", "indexes", "values"]:
+                array = np.zeros(capacity, dtype=np.int32)
+                array[: self.number_values] = getattr(self, name)[: self.number_values]
+                setattr(self, name, array)
+        self.steps[self.number_values : end] = self.length
+        self.indexes[self.number_values : end] = indexes
+        self.values[self.number_values : end] = values[indexes]
+        self.number_values = end
+        self.length += 1
+
+    def to_dict(self, label: str) -> dict:
+        """
+        Return the recorded values to be saved using keys starting with label.
+        """
+        return {
+            "{}_shape".format(label): np.array([self.length, self.width]),
+            "{}_steps".format(label): self.steps[: self.number_values],
+            "{}_indexes".format(label): self.indexes[: self.number_values],
+            "{}_values".format(label): self.values[: self.number_values],
+        }
+
+    @staticmethod
+    def to_dense(data: dict, label: str) -> np.array:
+        """
+        Return the 2-D array (steps, width) saved by to_dict() with label. Files
+        saved with the dense array are returned without changes.
+        """
+        if label in data:
+            return data[label]
+        dense = np.zeros(data["{}_shape".format(label)])
+        steps, indexes, values = (
+            data["{}_{}".format(label, name)] for name in ["steps", "indexes", "values"]
+        )
+        dense[steps, indexes] = values
+        return dense
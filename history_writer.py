@@ -0,0 +1,127 @@
+import os
+import queue
+import threading
+
+import numpy as np
+
+
+class HistoryWriter:
+    """
+    Class writing the history files in a background thread, so the simulation
+    does not wait for the compression or the filesystem. The simulation only
+    copies the values to be written and enqueues a job, which is executed by
+    the thread in the same order. The queue is bounded, so the simulation waits
+    (back-pressure) only when the thread is max_queue_size jobs behind. The
+    jobs are:
+    - appending a chunk of rows to an append-only file ("{path}.chunks"),
+      where each chunk is a .npy record (read using read_chunks());
+    - saving a compressed .npz file, which may join the rows of a chunks file,
+      removed afterwards;
+    - calling a function (not plotting, since pyplot is not thread-safe).
+    Errors raised in the thread are raised again in the next call.
+    """
+
+    def __init__(self, max_queue_size: int = 64) -> None:
+        self.jobs = queue.Queue(max_queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self) -> None:
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                function, args = job
+                function(*args)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.jobs.task_done()
+
+    def check_error(self) -> None:
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise Exception("History writer failed") from error
+
+    def submit(self, function, *args) -> None:
+        """
+        Call the function in the thread after the previous jobs.
+        """
+        self.check_error()
+        self.jobs.put((function, args))
+
+    def append_chunk(self, path: str, rows: np.array, new: bool = False) -> None:
+        """
+        Append a copy of the rows to the chunks file, which is restarted if new
+        is True.
+        """
+        self.submit(HistoryWriter.write_chunk, path, np.array(rows), new)
+
+    def save(
+        self,
+        path: str,
+        arrays: dict,
+        chunks_path: str = None,
+        columns: dict = None,
+    ) -> None:
+        """
+        Save a copy of the arrays in a compressed file. The rows of the chunks
+        file are included using the column (or columns) of each label.
+        """
+        self.submit(
+            HistoryWriter.write_file,
+            path,
+            {label: np.array(values) for label, values in arrays.items()},
+            chunks_path,
+            columns,
+        )
+
+    def flush(self) -> None:
+        """
+        Wait until all jobs are written.
+        """
+        self.jobs.join()
+        self.check_error()
+
+    def close(self) -> None:
+        if self.thread.is_alive():
+            self.flush()
+            self.jobs.put(None)
+            self.thread.join()
+
+    @staticmethod
+    def write_chunk(path: str, rows: np.array, new: bool) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "wb" if new else "ab") as file:
+            np.save(file, rows)
+
+    @staticmethod
+    def read_chunks(path: str) -> np.array:
+        """
+        Return the rows of all chunks of the file.
+        """
+        chunks = []
+        with open(path, "rb") as file:
+            size = os.fstat(file.fileno()).st_size
+            while file.tell() < size:
+                chunks.append(np.load(file))
+
+        return np.concatenate(chunks)
+
+    @staticmethod
+    def write_file(
+        path: str, arrays: dict, chunks_path: str = None, columns: dict = None
+    ) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        if chunks_path is not None:
+            rows = HistoryWriter.read_chunks(chunks_path)
+            arrays.update({label: rows[:, column] for label, column in columns.items()})
+        # Written to a temporary file and renamed, so readers never find a
+        # partial file
+        tmp_path = "{}.tmp.npz".format(path)
+        np.savez_compressed(tmp_path, **arrays)
+        os.replace(tmp_path, "{}.npz".format(path))
+        if chunks_path is not None:
+            os.remove(chunks_path)
@@ -1,4 +1,5 @@
 import numpy as np
+from ue import UE
 from modelpack.UserData import UserData
 from modelpack.ModelData import ModelData
 from modelpack.SliceData import SliceData
@@ -92,7 +93,7 @@ data = ModelData(
 # Reading UE files
 ue_hist_per_slice = {"embb":[], "urllc":[], "be":[]}
 for u in range(1,EMBB_USERS + URLLC_USERS + BE_USERS + 1):
-    ue_hist = np.load(ue_file_loc_base.format(trial_num=TRIAL, ue_id=u))
+    ue_hist = UE.load_aux_hist(ue_file_loc_base.format(trial_num=TRIAL, ue_id=u))
     ue_hist_per_slice[str(ue_hist["slice"])].append(ue_hist)
 
 STEPS = len(ue_hist_per_slice["embb"][0]["real_served_thr"])
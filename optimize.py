@@ -165,6 +165,7 @@ def objective(trial: optuna.Trial) -> float:
         obs_space_mode=obs_space_mode,
         root_path="../intent-slicing-simulation",
         rng=rng,
+        history_level="off",
     )
     env = Monitor(env)
     env = DummyVecEnv([lambda: env])
@@ -0,0 +1,81 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+
+class PlotQueue:
+    """
+    Class rendering the plots out of the simulation. The environment submits
+    render jobs, i.e., a static function and the in-memory arrays to be
+    plotted (copied, so the hists can be overwritten in the next trial), and
+    the jobs are rendered by a pool of number_workers processes. Deferred jobs
+    are kept until render() is called, e.g., after the run, otherwise they are
+    rendered alongside the simulation. Errors raised by the jobs are raised
+    again in the next call.
+    """
+
+    def __init__(self, number_workers: int = None, deferred: bool = True) -> None:
+        self.number_workers = (
+            os.cpu_count() if number_workers is None else number_workers
+        )
+        self.deferred = deferred
+        self.jobs = []
+        self.futures = []
+        self.executor = None
+
+    def get_executor(self) -> ProcessPoolExecutor:
+        # Forked workers do not import the main script again, which has no
+        # __main__ guard in the run scripts
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(
+                self.number_workers, mp_context=multiprocessing.get_context("fork")
+            )
+
+        return self.executor
+
+    def check_errors(self, wait: bool = False) -> None:
+        """
+        Remove the finished jobs, raising the first error found. All jobs
+        are finished if wait is True.
+        """
+        futures, self.futures = self.futures, []
+        for i, future in enumerate(futures):
+            if not (wait or future.done()):
+                self.futures.append(future)
+                continue
+            error = future.exception()
+            if error is not None:
+                if not wait:
+                    self.futures.extend(futures[i + 1 :])
+                else:
+                    for remaining in futures[i + 1 :]:
+                        remaining.exception()
+                raise Exception("Plot rendering failed") from error
+
+    def submit(self, function, *args) -> None:
+        """
+        Add a job calling the function with the given arguments.
+        """
+        self.check_errors()
+        if self.deferred:
+            self.jobs.append((function, args))
+        else:
+            self.futures.append(self.get_executor().submit(function, *args))
+
+    def render(self) -> None:
+        """
+        Render the deferred jobs and wait until all jobs are finished.
+        """
+        if len(self.jobs) > 0:
+            executor = self.get_executor()
+            self.futures.extend(
+                executor.submit(function, *args) for function, args in self.jobs
+            )
+            self.jobs = []
+        self.check_errors(wait=True)
+
+    def close(self) -> None:
+        self.render()
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
@@ -3,7 +3,7 @@ import os
 import matplotlib.pyplot as plt
 import numpy as np
 
-from basestation import Basestation
+from results_cube import ResultsCube
 from slice import Slice
 
 slices = {
@@ -59,8 +59,10 @@ def plot_agents_reqs(
     agents: list,
     windows_sizes: list,
     obs_spaces: list,
+    results: ResultsCube = None,
 ) -> None:
     x_label = "Time (ms)"
+    results = ResultsCube() if results is None else results
 
     for attribute in data_index.keys():
         w, h = plt.figaspect(0.6)
@@ -91,20 +93,14 @@ def plot_agents_reqs(
                             in slices_req[list(slices_req.keys())[0]][slice].keys()
                         ):
                             # req_values = [0, slices_req]
-                            hist = np.array([])
-                            for trial_number in trial_numbers:
-                                hist = np.append(
-                                    hist,
-                                    Slice.read_hist(
-                                        "test/{}/ws_{}/{}/".format(
-                                            agent,
-                                            windows_size,
-                                            obs_space,
-                                        ),
-                                        trial_number,
-                                        slices[slice],
-                                    )[data_index[attribute][0]],
-                                )
+                            hist = results.get_slice_hist(
+                                agent,
+                                windows_size,
+                                obs_space,
+                                trial_numbers,
+                                slices[slice],
+                                Slice.hist_labels[data_index[attribute][0]],
+                            )
                             x_values = range(0, len(hist))
                             markevery = 200
                             if attribute == "throughput":
@@ -182,8 +178,10 @@ def plot_rewards(
     obs_spaces: list,
     order: list = [],
     cumulative: bool = False,
+    results: ResultsCube = None,
 ) -> None:
     x_label = "Time (ms)"
+    results = ResultsCube() if results is None else results
 
     data_index = {
         "reward": 1,
@@ -214,20 +212,10 @@ def plot_rewards(
                             if len(agents) > 1
                             else ""
                         )
-                        hist = np.array([])
-                        for trial_number in trial_numbers:
-                            hist = np.append(
-                                hist,
-                                Basestation.read_hist(
-                                    "test/{}/ws_{}/{}/".format(
-                                        agent,
-                                        windows_size,
-                                        obs_space,
-                                    ),
-                                    trial_number,
-                                )[data_index[attribute]],
-                            )
-                        hist = np.cumsum(hist) if cumulative else hist
+                        hist = results.get_rewards(
+                            agent, windows_size, obs_space, trial_numbers
+                        )
+                        hist = np.cumsum(hist, dtype=float) if cumulative else hist
                         plt.plot(
                             range(0, len(hist)),
                             hist,
@@ -266,8 +254,10 @@ def plot_rewards(
 def plot_rcv_thr(
     fig_name: str,
     trial_numbers: list,
+    results: ResultsCube = None,
 ) -> None:
     x_label = "Time (ms)"
+    results = ResultsCube() if results is None else results
 
     w, h = plt.figaspect(0.6)
     fig = plt.figure(figsize=(w, h))
@@ -287,20 +277,9 @@ def plot_rcv_thr(
         windows_size = 1
         obs_space = "full"
         # req_values = [0, slices_req]
-        hist = np.array([])
-        for trial_number in trial_numbers:
-            hist = np.append(
-                hist,
-                Slice.read_hist(
-                    "test/{}/ws_{}/{}/".format(
-                        agent,
-                        windows_size,
-                        obs_space,
-                    ),
-                    trial_number,
-                    slices[slice],
-                )[0],
-            )
+        hist = results.get_slice_hist(
+            agent, windows_size, obs_space, trial_numbers, slices[slice], "pkt_rcv"
+        )
         plt.plot(
             range(0, len(hist)),
             hist,
@@ -345,6 +324,9 @@ slice_requirements_traffics = {
     },
 }
 
+# Test hists joined once in the results cube, updated with the new trials
+results = ResultsCube()
+
 ##### Comparing different windows sizes for full and partial obs space
 plot_rewards(
     "reward",
@@ -356,6 +338,7 @@ plot_rewards(
     ["full", "partial"],
     # [2, 0, 1],
     cumulative=True,
+    results=results,
 )
 
 plot_agents_reqs(
@@ -365,6 +348,7 @@ plot_agents_reqs(
     ["pf", "sac", "intentless", "colran"],
     [1],
     ["partial"],
+    results=results,
 )
 
-plot_rcv_thr("requested", [46])  # np.arange(46, 51),
+plot_rcv_thr("requested", [46], results=results)  # np.arange(46, 51),
@@ -0,0 +1,341 @@
+import os
+import re
+
+import numpy as np
+
+from basestation import Basestation
+from slice import Slice
+
+
+class ResultsCube:
+    """
+    Class joining the test hists of all agents in memory-mapped files (results
+    cube), so the results are plotted without decompressing the hist files
+    again. The slices cube has shape (agent, obs space, windows size, slice,
+    metric, trial, step), where the metrics are the slice hist labels and the
+    RBs allocated to the slice, and the rewards cube has shape (agent, obs
+    space, windows size, trial, step). The trials are the axis before the
+    steps, so consecutive trials are read as a single view.
+
+    The catalog contains the values of each axis, the number of steps of each
+    run (0 if missing) and the modification time of its hist files. The cube
+    is updated when it is opened, reading only the runs that are new or were
+    saved again.
+    """
+
+    catalog_file = "catalog.npz"
+    slices_file = "slices.npy"
+    rewards_file = "rewards.npy"
+    metrics = Slice.hist_labels + ["rbs"]
+    run_axes = ["agents", "obs_spaces", "windows_sizes", "trials"]
+    run_pattern = re.compile(r"^test/([^/]+)/ws_(\d+)/([^/]+)/trial(\d+)$")
+    slice_pattern = re.compile(r"^slice(\d+)\.npz$")
+
+    def __init__(self, root_path: str = ".", cube_path: str = None) -> None:
+        self.root_path = root_path
+        self.cube_path = (
+            "{}/results/cube".format(root_path) if cube_path is None else cube_path
+        )
+        self.update()
+
+    @staticmethod
+    def get_bs_name(agent: str, windows_size: int, obs_space: str) -> str:
+        return "test/{}/ws_{}/{}/".format(agent, windows_size, obs_space)
+
+    def find_runs(self) -> dict:
+        """
+        Return the slice ids and the last modification time of the hist files
+        of each run (agent, obs space, windows size, trial) saved in the test
+        hists.
+        """
+        runs = {}
+        hist_path = "{}/hist".format(self.root_path)
+        for dir_path, _, filenames in os.walk("{}/test".format(hist_path)):
+            match = self.run_pattern.match(
+                os.path.relpath(dir_path, hist_path).replace(os.sep, "/")
+            )
+            if match is None or "bs.npz" not in filenames:
+                continue
+            slices_path = os.path.join(dir_path, "slices")
+            slice_files = [
+                filename
+                for filename in sorted(os.listdir(slices_path))
+                if self.slice_pattern.match(filename) is not None
+            ]
+            agent, windows_size, obs_space, trial = match.groups()
+            runs[(agent, obs_space, int(windows_size), int(trial))] = (
+                [int(self.slice_pattern.match(name).group(1)) for name in slice_files],
+                max(
+                    os.path.getmtime(path)
+                    for path in [os.path.join(dir_path, "bs.npz")]
+                    + [os.path.join(slices_path, name) for name in slice_files]
+                ),
+            )
+
+        return runs
+
+    def load_catalog(self) -> dict:
+        path = os.path.join(self.cube_path, self.catalog_file)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            return {label: data[label] for label in data.files}
+
+    @staticmethod
+    def get_run_position(catalog: dict, run: tuple) -> tuple:
+        """
+        Return the position of the run in the cube axes, or None if any of its
+        values is not in the catalog.
+        """
+        position = []
+        for label, value in zip(ResultsCube.run_axes, run):
+            index = np.flatnonzero(catalog[label] == value)
+            if index.shape[0] == 0:
+                return None
+            position.append(int(index[0]))
+
+        return tuple(position)
+
+    def update(self) -> None:
+        """
+        Write the new runs in the cube and open it. The cube is created again
+        when the axes grow, copying the runs that were already written.
+        """
+        runs = self.find_runs()
+        catalog = self.load_catalog()
+        if catalog is None and len(runs) == 0:
+            raise Exception(
+                'No test hists were found in "{}/hist/test"'.format(self.root_path)
+            )
+        stale_runs = [
+            run
+            for run, (_, mtime) in runs.items()
+            if catalog is None
+            or self.get_run_position(catalog, run) is None
+            or catalog["mtimes"][self.get_run_position(catalog, run)] != mtime
+        ]
+        if len(stale_runs) > 0:
+            self.write_runs(catalog, runs, stale_runs)
+            catalog = self.load_catalog()
+        self.catalog = catalog
+        self.slices = np.load(
+            os.path.join(self.cube_path, self.slices_file), mmap_mode="r"
+        )
+        self.rewards = np.load(
+            os.path.join(self.cube_path, self.rewards_file), mmap_mode="r"
+        )
+
+    def write_runs(self, catalog: dict, runs: dict, stale_runs: list) -> None:
+        """
+        Write the hists of the stale runs in the cube, followed by the catalog,
+        so an interrupted update is done again in the next one.
+        """
+        hists = {}
+        for run in stale_runs:
+            bs_name = self.get_bs_name(run[0], run[2], run[1])
+            hists[run] = (
+                Basestation.read_hist(bs_name, run[3], self.root_path),
+                {
+                    slice_id: Slice.read_hist(bs_name, run[3], slice_id, self.root_path)
+                    for slice_id in runs[run][0]
+                },
+            )
+        axes = {
+            label: np.unique(
+                ([] if catalog is None else catalog[label].tolist())
+                + [run[i] for run in stale_runs]
+            )
+            for i, label in enumerate(self.run_axes)
+        }
+        axes["slices"] = np.unique(
+            ([] if catalog is None else catalog["slices"].tolist())
+            + [slice_id for run in stale_runs for slice_id in runs[run][0]]
+        )
+        number_steps = max(
+            [0 if catalog is None else int(catalog["number_steps"])]
+            + [rewards.shape[0] for (_, rewards), _ in hists.values()]
+        )
+        slices_cube, rewards_cube, catalog = self.open_writable(
+            catalog, axes, number_steps
+        )
+
+        for run in stale_runs:
+            position = self.get_run_position(catalog, run)
+            (actions, rewards), slices_hists = hists[run]
+            length = rewards.shape[0]
+            rewards_cube[position][:length] = rewards
+            run_slices = slices_cube[position[:3]][..., position[3], :]
+            run_slices[:] = 0
+            for slice_id, hist in slices_hists.items():
+                slice_index = int(np.flatnonzero(catalog["slices"] == slice_id)[0])
+                run_slices[slice_index, :-1, :length] = hist
+                run_slices[slice_index, -1, :length] = actions[slice_id - 1]
+            catalog["lengths"][position] = length
+            catalog["mtimes"][position] = runs[run][1]
+        slices_cube.flush()
+        rewards_cube.flush()
+
+        catalog_path = os.path.join(self.cube_path, self.catalog_file)
+        tmp_suffix = ".{}.tmp".format(os.getpid())
+        with open(catalog_path + tmp_suffix, "wb") as catalog_file:
+            np.savez(catalog_file, **catalog)
+        os.replace(catalog_path + tmp_suffix, catalog_path)
+
+    def open_writable(self, catalog: dict, axes: dict, number_steps: int) -> tuple:
+        """
+        Return the slices and rewards cubes opened for writing and the catalog
+        of the given axes. The files are created again when the axes do not
+        match the catalog ones.
+        """
+        slices_path = os.path.join(self.cube_path, self.slices_file)
+        rewards_path = os.path.join(self.cube_path, self.rewards_file)
+        runs_shape = tuple(axes[label].shape[0] for label in self.run_axes)
+        if (
+            catalog is not None
+            and int(catalog["number_steps"]) == number_steps
+            and all(np.array_equal(catalog[label], axes[label]) for label in axes)
+        ):
+            return (
+                np.load(slices_path, mmap_mode="r+"),
+                np.load(rewards_path, mmap_mode="r+"),
+                catalog,
+            )
+
+        os.makedirs(self.cube_path, exist_ok=True)
+        tmp_suffix = ".{}.tmp".format(os.getpid())
+        slices_cube = np.lib.format.open_memmap(
+            slices_path + tmp_suffix,
+            mode="w+",
+            dtype=np.float32,
+            shape=runs_shape[:3]
+            + (axes["slices"].shape[0], len(self.metrics))
+            + runs_shape[3:]
+            + (number_steps,),
+        )
+        rewards_cube = np.lib.format.open_memmap(
+            rewards_path + tmp_suffix,
+            mode="w+",
+            dtype=np.float32,
+            shape=runs_shape + (number_steps,),
+        )
+        new_catalog = dict(
+            axes,
+            number_steps=number_steps,
+            lengths=np.zeros(runs_shape, dtype=int),
+            mtimes=np.zeros(runs_shape),
+        )
+        if catalog is not None:
+            positions = {
+                label: np.searchsorted(axes[label], catalog[label]) for label in axes
+            }
+            steps = np.arange(int(catalog["number_steps"]))
+            runs_positions = [positions[label] for label in self.run_axes]
+            rewards_cube[np.ix_(*runs_positions, steps)] = np.load(rewards_path)
+            slices_cube[
+                np.ix_(
+                    *runs_positions[:3],
+                    positions["slices"],
+                    np.arange(len(self.metrics)),
+                    positions["trials"],
+                    steps,
+                )
+            ] = np.load(slices_path)
+            runs_positions = np.ix_(*runs_positions)
+            new_catalog["lengths"][runs_positions] = catalog["lengths"]
+            new_catalog["mtimes"][runs_positions] = catalog["mtimes"]
+        slices_cube.flush()
+        rewards_cube.flush()
+        os.replace(slices_path + tmp_suffix, slices_path)
+        os.replace(rewards_path + tmp_suffix, rewards_path)
+
+        return slices_cube, rewards_cube, new_catalog
+
+    def get_runs_steps(
+        self,
+        agent: str,
+        windows_size: int,
+        obs_space: str,
+        trial_numbers: list,
+    ) -> tuple:
+        """
+        Return the position of the (agent, obs space, windows size) runs, the
+        positions of the trials and their number of steps.
+        """
+        positions = [
+            self.get_run_position(
+                self.catalog, (agent, obs_space, windows_size, trial_number)
+            )
+            for trial_number in trial_numbers
+        ]
+        for trial_number, position in zip(trial_numbers, positions):
+            if position is None or self.catalog["lengths"][position] == 0:
+                raise Exception(
+                    "Trial {} of {} was not found in the results cube".format(
+                        trial_number,
+                        self.get_bs_name(agent, windows_size, obs_space),
+                    )
+                )
+
+        return (
+            positions[0][:3],
+            np.array([position[3] for position in positions]),
+            np.array([self.catalog["lengths"][position] for position in positions]),
+        )
+
+    def get_trials_hist(
+        self, values: np.array, trials: np.array, lengths: np.array
+    ) -> np.array:
+        """
+        Return the concatenated steps of the trials from values with shape
+        (trial, step), which is a view when the trials are consecutive and
+        have all steps.
+        """
+        if np.all(np.diff(trials) == 1) and np.all(lengths == values.shape[-1]):
+            return values[trials[0] : trials[-1] + 1].reshape(-1)
+
+        return np.concatenate(
+            [values[trial, :length] for trial, length in zip(trials, lengths)]
+        )
+
+    def get_slice_hist(
+        self,
+        agent: str,
+        windows_size: int,
+        obs_space: str,
+        trial_numbers: list,
+        slice_id: int,
+        metric: str,
+    ) -> np.array:
+        """
+        Return the values of a slice metric over the given trials (read-only).
+        """
+        run, trials, lengths = self.get_runs_steps(
+            agent, windows_size, obs_space, trial_numbers
+        )
+        slice_index = np.flatnonzero(self.catalog["slices"] == slice_id)
+        if slice_index.shape[0] == 0:
+            raise Exception(
+                "Slice {} was not found in the results cube".format(slice_id)
+            )
+
+        return self.get_trials_hist(
+            self.slices[run][slice_index[0], self.metrics.index(metric)],
+            trials,
+            lengths,
+        )
+
+    def get_rewards(
+        self,
+        agent: str,
+        windows_size: int,
+        obs_space: str,
+        trial_numbers: list,
+    ) -> np.array:
+        """
+        Return the basestation rewards over the given trials (read-only).
+        """
+        run, trials, lengths = self.get_runs_steps(
+            agent, windows_size, obs_space, trial_numbers
+        )
+
+        return self.get_trials_hist(self.rewards[run], trials, lengths)
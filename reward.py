@@ -0,0 +1,178 @@
+import numpy as np
+
+
+class Reward:
+    """
+    Class containing the reward functions of the basestation. Each reward
+    definition returns a list of terms, where each term is a tuple
+    (slice name, hist label, kind, weight, threshold, scale) over the last
+    slice hist values (without windows). The kinds of terms are:
+    - "linear": weight * value;
+    - "exp": weight * exp(-value);
+    - "below": -weight * (threshold - value) / scale if value < threshold;
+    - "above": -weight * (value - threshold) / scale if value > threshold.
+    The terms are compiled into arrays when the slice requirements change, so
+    the reward of all slices is calculated at once in each step. New rewards
+    are added using Reward.register() without changing the basestation.
+    """
+
+    definitions = {}
+
+    def __init__(self, name: str, slice_names: list, hist_labels: list) -> None:
+        if name not in Reward.definitions:
+            raise Exception('Reward "{}" is not valid'.format(name))
+        self.name = name
+        self.definition = Reward.definitions[name]
+        self.slice_rows = {
+            slice_name: row for row, slice_name in enumerate(slice_names)
+        }
+        self.hist_columns = {label: col for col, label in enumerate(hist_labels)}
+
+    @staticmethod
+    def register(name: str, definition) -> None:
+        """
+        Add a reward definition, which is a function receiving the basestation
+        and returning the list of reward terms.
+        """
+        Reward.definitions[name] = definition
+
+    def compile(self, basestation) -> None:
+        """
+        Convert the reward terms into arrays containing the position of the
+        value in the flattened slice hist matrix, the weights, thresholds and
+        scales of each kind of term. Penalties ("below" and "above") are joined
+        using a sign to invert the difference between threshold and value.
+        """
+        terms = [
+            term for term in self.definition(basestation) if term[0] in self.slice_rows
+        ]
+        kinds = np.array([term[2] for term in terms], dtype=str)
+        indexes = np.array(
+            [
+                self.slice_rows[term[0]] * len(self.hist_columns)
+                + self.hist_columns[term[1]]
+                for term in terms
+            ],
+            dtype=int,
+        )
+        weights, thresholds, scales = (
+            np.array([term[i] for term in terms], dtype=float).reshape(-1)
+            for i in range(3, 6)
+        )
+        linear = kinds == "linear"
+        exp = kinds == "exp"
+        penalty = (kinds == "below") | (kinds == "above")
+        self.linear_indexes = indexes[linear]
+        self.linear_weights = weights[linear]
+        self.exp_indexes = indexes[exp]
+        self.exp_weights = weights[exp]
+        self.penalty_indexes = indexes[penalty]
+        self.penalty_weights = weights[penalty]
+        self.penalty_thresholds = thresholds[penalty]
+        self.penalty_signs = np.where(kinds[penalty] == "below", 1.0, -1.0)
+        # Null requirements can not be violated (values are not negative)
+        self.penalty_scales = np.where(scales[penalty] != 0, scales[penalty], np.inf)
+
+    def calculate(self, slices_hist: np.array) -> float:
+        """
+        Calculate the reward using the matrix with the last slice hist values,
+        where each row is a slice.
+        """
+        values = slices_hist.reshape(-1).astype(np.float64)
+
+        return float(
+            np.dot(self.linear_weights, values[self.linear_indexes])
+            + np.dot(self.exp_weights, np.exp(-values[self.exp_indexes]))
+            - np.dot(
+                self.penalty_weights,
+                np.maximum(
+                    self.penalty_signs
+                    * (self.penalty_thresholds - values[self.penalty_indexes]),
+                    0,
+                )
+                / self.penalty_scales,
+            )
+        )
+
+
+def main_reward(basestation) -> list:
+    """
+    Penalties proportional to the violation of each slice requirement.
+    """
+    requirements = basestation.slice_requirements
+    norm_factors = basestation.slice_req_norm_factors
+    max_lat = basestation.buffer_max_lat / norm_factors[1]
+    terms = []
+    for name, weights, offset in [
+        ("embb", [0.2, 0.05, 0.05], 0),
+        ("urllc", [0.1, 0.25, 0.25], 3),
+    ]:
+        if name not in requirements:
+            continue
+        req_thr = requirements[name]["throughput"] / norm_factors[offset]
+        req_lat = requirements[name]["latency"] / norm_factors[offset + 1]
+        req_loss = requirements[name]["pkt_loss"] / norm_factors[offset + 2]
+        terms.extend(
+            [
+                (name, "pkt_thr", "below", weights[0], req_thr, req_thr),
+                (name, "avg_lat", "above", weights[1], req_lat, max_lat - req_lat),
+                (name, "pkt_loss", "above", weights[2], req_loss, 1 - req_loss),
+            ]
+        )
+    if "be" in requirements:
+        req_long = requirements["be"]["long_term_pkt_thr"] / norm_factors[6]
+        req_fifth = requirements["be"]["fifth_perc_pkt_thr"] / norm_factors[7]
+        terms.extend(
+            [
+                ("be", "long_term_pkt_thr", "below", 0.05, req_long, req_long),
+                ("be", "fifth_perc_pkt_thr", "below", 0.05, req_fifth, req_fifth),
+            ]
+        )
+
+    return terms
+
+
+def intentless_reward(basestation) -> list:
+    """
+    Weighted latency, packet loss and throughput of each slice, without
+    considering the slice requirements.
+    """
+    slice_weights = {
+        "embb": np.array([1, 0.5, 2e-4]),
+        "urllc": np.array([2, 1, 4e-4]),
+        "be": np.array([1, 0.5, 2e-4]) * (1 / 5),
+    }
+
+    return [
+        term
+        for name, weights in slice_weights.items()
+        for term in [
+            (name, "avg_lat", "exp", weights[0], 0, 0),
+            (name, "pkt_loss", "exp", weights[1], 0, 0),
+            (name, "pkt_thr", "linear", weights[2], 0, 0),
+        ]
+    ]
+
+
+def colran_reward(basestation) -> list:
+    """
+    eMBB throughput and BE fifth percentile throughput minus the URLLC
+    buffer occupancy (Mb).
+    """
+    return [
+        ("embb", "pkt_thr", "linear", 1, 0, 0),
+        (
+            "urllc",
+            "buffer_occ",
+            "linear",
+            -basestation.max_packets_buffer * basestation.packet_size / 1e6,
+            0,
+            0,
+        ),
+        ("be", "fifth_perc_pkt_thr", "linear", 1, 0, 0),
+    ]
+
+
+Reward.register("main", main_reward)
+Reward.register("intentless", intentless_reward)
+Reward.register("colran", colran_reward)
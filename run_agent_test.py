@@ -11,6 +11,7 @@ from tqdm import tqdm
 from baselines import BaselineAgent
 from basestation import Basestation
 from callbacks import ProgressBarManager
+from plot_queue import PlotQueue
 
 test_param = {
     "steps_per_trial": 2000, #2000,
@@ -66,6 +67,13 @@ seed = 100
 n_eval_episodes = 5  # default is 5
 eval_freq = 10000  # default is 10000
 test_model = "best"  # or last
+# Evaluate all agents over the same traffic trace of each trial and report the
+# paired differences of their trial rewards to the first model
+common_random_numbers = False
+confidence_level = 0.95
+# Render the plots of the saved hists in a process pool after the test runs,
+# instead of inside the environment steps
+deferred_plots = True
 
 
 # Instantiate the agent
@@ -173,12 +181,74 @@ def create_agent(
             return BaselineAgent("rr")
 
 
+def create_traffic_schedules(env_args: dict, trials: range, seed: int) -> dict:
+    """
+    Draw once the traffic schedule (UE arrivals and slice requirements) of
+    each test trial, which is replayed by the environment of every agent.
+    """
+    env = Basestation(
+        bs_name="test/traffic_schedules/",
+        rng=np.random.default_rng(seed) if seed != -1 else np.random.default_rng(),
+        history_level="off",
+        record_aux_hist=False,
+        **env_args,
+    )
+
+    return {trial: env.create_traffic_schedule() for trial in trials}
+
+
+def paired_differences(
+    values: np.array,
+    reference_values: np.array,
+    confidence: float = 0.95,
+    number_resamples: int = 10000,
+    rng: np.random.Generator = None,
+) -> tuple:
+    """
+    Return the mean of the differences between the trial values of two agents
+    evaluated over the same trials, and its bootstrap confidence interval.
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    differences = np.asarray(values) - np.asarray(reference_values)
+    resampled_means = np.mean(
+        rng.choice(differences, size=(number_resamples, differences.shape[0])),
+        axis=1,
+    )
+    low, high = np.quantile(
+        resampled_means, [(1 - confidence) / 2, (1 + confidence) / 2]
+    )
+
+    return np.mean(differences), low, high
+
+
 # Test
 print("\n############### Testing ###############")
 #models_test = np.append(models, ["mt", "rr", "pf"])
 models_test = models
+test_trials = range(test_param["initial_trial"], test_param["total_trials"] + 1)
+plot_queue = PlotQueue() if deferred_plots else None
 for windows_size_obs in tqdm(windows_sizes, desc="Windows size", leave=False):
     for obs_space_mode in tqdm(obs_space_modes, desc="Obs. Space mode", leave=False):
+        env_args = dict(
+            bandwidth=1e8, # Original = 1e8
+            total_number_rbs = 100, # Original = 17
+            number_ues=EMBB_USERS + URLLC_USERS + BE_USERS,
+            max_number_steps=test_param["steps_per_trial"],
+            max_number_trials=test_param["total_trials"],
+            initial_trial=test_param["initial_trial"],
+            traffic_types=traffic_types,
+            traffic_throughputs=traffic_throughputs,
+            slice_requirements_traffics=slice_requirements_traffics,
+            windows_size_obs=windows_size_obs,
+            obs_space_mode=obs_space_mode,
+            baseline=False,
+        )
+        traffic_schedules = (
+            create_traffic_schedules(env_args, test_trials, seed)
+            if common_random_numbers
+            else None
+        )
+        trial_rewards = {}
         for model in tqdm(models_test, desc="Models", leave=False):
             rng = np.random.default_rng(seed) if seed != -1 else np.random.default_rng()
             env = Basestation(
@@ -187,20 +257,12 @@ for windows_size_obs in tqdm(windows_sizes, desc="Windows size", leave=False):
                     windows_size_obs,
                     obs_space_mode,
                 ),
-                bandwidth=1e8, # Original = 1e8
-                total_number_rbs = 100, # Original = 17
-                number_ues=EMBB_USERS + URLLC_USERS + BE_USERS,
-                max_number_steps=test_param["steps_per_trial"],
-                max_number_trials=test_param["total_trials"],
-                traffic_types=traffic_types,
-                traffic_throughputs=traffic_throughputs,
-                slice_requirements_traffics=slice_requirements_traffics,
-                windows_size_obs=windows_size_obs,
-                obs_space_mode=obs_space_mode,
                 rng=rng,
                 plots=True,
                 save_hist=True,
-                baseline=False,
+                traffic_schedules=traffic_schedules,
+                plot_queue=plot_queue,
+                **env_args,
             )
 
             if model in models:
@@ -222,8 +284,9 @@ for windows_size_obs in tqdm(windows_sizes, desc="Windows size", leave=False):
                 model, env, "test", obs_space_mode, windows_size_obs, test_model
             )
             agent.set_random_seed(seed)
-            for _ in tqdm(
-                range(test_param["total_trials"] + 1 - test_param["initial_trial"]),
+            trial_rewards[model] = np.zeros(len(test_trials))
+            for trial in tqdm(
+                range(len(test_trials)),
                 leave=False,
                 desc="Trials",
             ):
@@ -242,5 +305,29 @@ for windows_size_obs in tqdm(windows_sizes, desc="Windows size", leave=False):
                         obs, rewards, dones, info = step
                     else:
                         obs, rewards, dones, _, info = step
+                    trial_rewards[model][trial] += np.sum(rewards)
                 if model not in models:
                     env.reset()
+
+        if common_random_numbers:
+            reference_model = models_test[0]
+            print(
+                "\nPaired trial reward differences to {} ({}, ws {}, {} trials):".format(
+                    reference_model, obs_space_mode, windows_size_obs, len(test_trials)
+                )
+            )
+            for model in models_test[1:]:
+                mean, low, high = paired_differences(
+                    trial_rewards[model],
+                    trial_rewards[reference_model],
+                    confidence_level,
+                    rng=np.random.default_rng(seed if seed != -1 else None),
+                )
+                print(
+                    "{}: {:.4f} ({:.0f}% CI [{:.4f}, {:.4f}])".format(
+                        model, mean, 100 * confidence_level, low, high
+                    )
+                )
+
+if plot_queue is not None:
+    plot_queue.close()
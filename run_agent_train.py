@@ -1,16 +1,24 @@
 import os
+import time
 
 import joblib
 import numpy as np
+import torch
 from stable_baselines3 import SAC, TD3, PPO, DDPG
 from stable_baselines3.common.callbacks import CheckpointCallback, EvalCallback
 from stable_baselines3.common.monitor import Monitor
-from stable_baselines3.common.vec_env import DummyVecEnv, VecNormalize
+from stable_baselines3.common.vec_env import (
+    DummyVecEnv,
+    SubprocVecEnv,
+    VecMonitor,
+    VecNormalize,
+)
 from tqdm import tqdm
 
 from baselines import BaselineAgent
 from basestation import Basestation
 from callbacks import ProgressBarManager
+from vec_env import BatchedBasestationEnv
 
 train_param = {
     "steps_per_trial": 2000, #2000,
@@ -64,6 +72,10 @@ models = ["sac"]
 obs_space_modes = ["partial"] # , "full"]
 windows_sizes = [1]  # , 50, 100] # Window for calculating the moving mean of metrics (not used)
 seed = 100
+number_envs = 1  # Cells stepped together by BatchedBasestationEnv when > 1
+number_workers = 1  # Basestation processes (SubprocVecEnv) when > 1
+if number_envs > 1 and number_workers > 1:
+    raise Exception("Use either number_envs or number_workers greater than 1")
 model_save_freq = int(
     train_param["total_trials"]
     * train_param["steps_per_trial"]
@@ -181,6 +193,44 @@ def create_agent(
 
 
 
+def partition_trials(first_trial: int, last_trial: int, number_workers: int) -> list:
+    """
+    Split the training trials into contiguous ranges (initial trial, last
+    trial), one for each worker, with sizes differing by at most one trial.
+    """
+    trials = np.arange(first_trial, last_trial + 1)
+    if number_workers > trials.shape[0]:
+        raise Exception(
+            "{} workers for only {} trials".format(number_workers, trials.shape[0])
+        )
+
+    return [
+        (int(worker_trials[0]), int(worker_trials[-1]))
+        for worker_trials in np.array_split(trials, number_workers)
+    ]
+
+
+def make_worker_env(env_args: dict, trials: tuple, seed_sequence):
+    """
+    Return the function creating the Basestation of a SubprocVecEnv worker,
+    which cycles over its own trials with an independent random stream.
+    """
+
+    def init_env():
+        # Workers only simulate, so one thread per process avoids oversubscription
+        torch.set_num_threads(1)
+        return Monitor(
+            Basestation(
+                initial_trial=trials[0],
+                max_number_trials=trials[1],
+                rng=np.random.default_rng(seed_sequence),
+                **env_args,
+            )
+        )
+
+    return init_env
+
+
 # Removing VecNormalize models from previous simulations
 dir_vec_models = "./vecnormalize_models"
 if not os.path.exists(dir_vec_models):
@@ -194,8 +244,7 @@ print("\n############### Training ###############")
 for windows_size_obs in tqdm(windows_sizes, desc="Windows size", leave=False):
     for obs_space_mode in tqdm(obs_space_modes, desc="Obs. Space mode", leave=False):
         for model in tqdm(models, desc="Models", leave=False):
-            rng = np.random.default_rng(seed) if seed != -1 else np.random.default_rng()
-            env = Basestation(
+            env_args = dict(
                 bs_name="train/{}/ws_{}/{}/".format(
                     model,
                     windows_size_obs,
@@ -210,19 +259,51 @@ for windows_size_obs in tqdm(windows_sizes, desc="Windows size", leave=False):
                 slice_requirements_traffics=slice_requirements_traffics,
                 windows_size_obs=windows_size_obs,
                 obs_space_mode=obs_space_mode,
-                rng=rng,
                 agent_type="main" if model not in ["intentless", "colran"] else model,
+                history_level="off", # Training only needs the obs and reward
             )
-            env = Monitor(env)
-            env = DummyVecEnv([lambda: env])
+            if number_workers > 1:
+                env_args.pop("max_number_trials")
+                seed_sequences = np.random.SeedSequence(
+                    seed if seed != -1 else None
+                ).spawn(number_workers)
+                env = SubprocVecEnv(
+                    [
+                        make_worker_env(env_args, trials, seed_sequence)
+                        for trials, seed_sequence in zip(
+                            partition_trials(
+                                1, train_param["total_trials"], number_workers
+                            ),
+                            seed_sequences,
+                        )
+                    ],
+                    start_method="fork",  # This script has no __main__ guard
+                )
+                # The learner uses the cores left by the workers
+                torch.set_num_threads(max(1, os.cpu_count() - number_workers))
+            elif number_envs > 1:
+                env = BatchedBasestationEnv(
+                    number_envs, seed if seed != -1 else None, **env_args
+                )
+                env = VecMonitor(env)
+            else:
+                rng = (
+                    np.random.default_rng(seed)
+                    if seed != -1
+                    else np.random.default_rng()
+                )
+                env = Monitor(Basestation(rng=rng, **env_args))
+                env = DummyVecEnv([lambda: env])
             dir_vec_file = dir_vec_models + "/{}_{}_ws{}.pkl".format(
                 model, obs_space_mode, windows_size_obs
             )
             env = VecNormalize(env)
             agent = create_agent(model, env, "train", obs_space_mode, windows_size_obs)
             agent.set_random_seed(seed)
+            # Callback frequencies are counted in vec env steps, each one with
+            # a transition of every env
             callback_checkpoint = CheckpointCallback(
-                save_freq=model_save_freq,
+                save_freq=max(model_save_freq // env.num_envs, 1),
                 save_path="./agents/",
                 name_prefix="{}_{}_ws{}".format(
                     model, obs_space_mode, windows_size_obs
@@ -235,7 +316,7 @@ for windows_size_obs in tqdm(windows_sizes, desc="Windows size", leave=False):
                     model, obs_space_mode, windows_size_obs
                 ),
                 n_eval_episodes=n_eval_episodes,
-                eval_freq=eval_freq,
+                eval_freq=max(eval_freq // env.num_envs, 1),
                 verbose=False,
                 warn=False,
             )
@@ -246,6 +327,7 @@ for windows_size_obs in tqdm(windows_sizes, desc="Windows size", leave=False):
                     * train_param["runs_per_agent"]
                 )
             ) as callback_progress_bar:
+                start_time = time.perf_counter()
                 agent.learn(
                     total_timesteps=int(
                         train_param["total_trials"]
@@ -258,9 +340,18 @@ for windows_size_obs in tqdm(windows_sizes, desc="Windows size", leave=False):
                         callback_evaluation,
                     ],
                 )
+                print(
+                    "{} ({}, ws {}): {:.1f} env-steps/s".format(
+                        model,
+                        obs_space_mode,
+                        windows_size_obs,
+                        agent.num_timesteps / (time.perf_counter() - start_time),
+                    )
+                )
             env.save(dir_vec_file)
             agent.save(
                 "./agents/{}_{}_ws{}".format(model, obs_space_mode, windows_size_obs)
             )
+            env.close()
 
 # PID: 546678
@@ -120,7 +120,7 @@ for s in env.slices:
         ue = UserData(
             id=u.id,
             s=s.name,
-            SE=u.se,
+            SE=u.se_gain * u.se,
             b_max=u.max_packets_buffer
         )
         slice.addUser(ue)
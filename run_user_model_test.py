@@ -117,7 +117,7 @@ data = ModelData(
 for s in env.slices:
     data.addSlice(s.name)
 for u in env.ues:
-    data.addUser(id=u.id, s=u.traffic_type, SE=u.se)
+    data.addUser(id=u.id, s=u.traffic_type, SE=u.se_gain * u.se)
 data.associateUsersToSlices()
 
 # Updates model requirements (may change in each step)
@@ -0,0 +1,164 @@
+import abc
+
+import numpy as np
+
+
+class Scheduler(abc.ABC):
+    """
+    Intra-slice scheduler dividing the RBs of each slice among its UEs. The UEs
+    of each slice are contiguous and slice_sizes contains the number of UEs of
+    each slice. The RBs of several basestations are divided at once using
+    batch_shape leading axes, where the last axis contains the slices (RBs
+    of each slice) or the UEs (SE and RBs of each UE). New schedulers are
+    added using Scheduler.register().
+    """
+
+    schedulers = {}
+
+    def __init__(self, slice_sizes: np.array, batch_shape: tuple = ()) -> None:
+        self.slice_sizes = np.asarray(slice_sizes, dtype=int)
+        self.batch_shape = tuple(batch_shape)
+        self.slice_starts = np.concatenate(([0], np.cumsum(self.slice_sizes)[:-1]))
+        self.ue_slices = np.repeat(
+            np.arange(self.slice_sizes.shape[0]), self.slice_sizes
+        )
+        self.ue_positions = (
+            np.arange(self.ue_slices.shape[0]) - self.slice_starts[self.ue_slices]
+        )
+        self.reset()
+
+    @staticmethod
+    def register(name: str, scheduler_class) -> None:
+        """
+        Add a scheduler class, which implements allocate().
+        """
+        Scheduler.schedulers[name] = scheduler_class
+
+    @staticmethod
+    def create(name: str, slice_sizes: np.array, batch_shape: tuple = ()):
+        if name not in Scheduler.schedulers:
+            raise Exception('Scheduler "{}" is not valid'.format(name))
+        return Scheduler.schedulers[name](slice_sizes, batch_shape)
+
+    def reset(self) -> None:
+        """
+        Restart the scheduler state for a new trial.
+        """
+        pass
+
+    @abc.abstractmethod
+    def allocate(self, rbs_slices: np.array, se: np.array) -> np.array:
+        """
+        Return the RBs of each UE given the RBs of each slice and the spectral
+        efficiency of each UE in this step.
+        """
+
+    def rank_in_slices(self, values: np.array) -> np.array:
+        """
+        Return the position of each UE in its slice when the UEs are sorted by
+        decreasing values, where ties are ranked to the UEs with higher
+        indexes first.
+        """
+        shape = values.shape
+        order = np.lexsort(
+            (
+                np.broadcast_to(-self.ue_positions, shape),
+                -values,
+                np.broadcast_to(self.ue_slices, shape),
+            ),
+            axis=-1,
+        )
+        ranks = np.empty(shape, dtype=int)
+        # Sorted UEs keep the slice segments, so the rank is the position
+        np.put_along_axis(ranks, order, np.broadcast_to(self.ue_positions, shape), -1)
+
+        return ranks
+
+    def distribute(self, rbs_slices: np.array, weights: np.array) -> np.array:
+        """
+        Divide the RBs of each slice proportionally to the UE weights, using
+        the largest remainder rounding. Slices without positive weights
+        divide their RBs equally.
+        """
+        sums = np.add.reduceat(weights, self.slice_starts, axis=-1)[..., self.ue_slices]
+        rbs_ues = rbs_slices[..., self.ue_slices]
+        shares = rbs_ues * np.where(
+            sums > 0,
+            weights / np.where(sums > 0, sums, 1),
+            1 / self.slice_sizes[self.ue_slices],
+        )
+        allocation = np.floor(shares)
+        missing_rbs = np.round(
+            rbs_slices - np.add.reduceat(allocation, self.slice_starts, axis=-1)
+        )[..., self.ue_slices]
+
+        return (
+            allocation + (self.rank_in_slices(shares - allocation) < missing_rbs)
+        ).astype(int)
+
+
+class RoundRobinScheduler(Scheduler):
+    """
+    Each UE receives the integer division of the slice RBs by the number of
+    UEs and the remaining RBs are given to the UEs with higher indexes. The
+    allocation is rotated by the rr_index of the slice in each step, giving
+    the same result of cycling the RBs over the UEs one by one.
+    """
+
+    def reset(self) -> None:
+        self.rr_index = np.zeros(self.batch_shape + self.slice_sizes.shape, dtype=int)
+
+    def allocate(self, rbs_slices: np.array, se: np.array) -> np.array:
+        slice_sizes = self.slice_sizes[self.ue_slices]
+        rbs_ues = rbs_slices[..., self.ue_slices]
+        unrolled_positions = (
+            self.ue_positions - self.rr_index[..., self.ue_slices]
+        ) % slice_sizes
+        allocation = rbs_ues // slice_sizes + (
+            unrolled_positions >= slice_sizes - rbs_ues % slice_sizes
+        )
+        self.rr_index[:] = (self.rr_index + 1) % self.slice_sizes
+
+        return allocation
+
+
+class ProportionalFairScheduler(Scheduler):
+    """
+    The slice RBs are divided proportionally to the ratio between the UE
+    spectral efficiency and its average served capacity (RBs times spectral
+    efficiency), which is an exponential moving average over time_constant
+    steps.
+    """
+
+    time_constant = 100
+
+    def reset(self) -> None:
+        self.average_capacities = np.zeros(
+            self.batch_shape + self.ue_slices.shape, dtype=float
+        )
+
+    def allocate(self, rbs_slices: np.array, se: np.array) -> np.array:
+        allocation = self.distribute(
+            rbs_slices, se / np.maximum(self.average_capacities, 1e-9)
+        )
+        self.average_capacities += (
+            allocation * se - self.average_capacities
+        ) / self.time_constant
+
+        return allocation
+
+
+class MaxSEScheduler(Scheduler):
+    """
+    All slice RBs are given to the UE with the highest spectral efficiency.
+    """
+
+    def allocate(self, rbs_slices: np.array, se: np.array) -> np.array:
+        return np.where(
+            self.rank_in_slices(se) == 0, rbs_slices[..., self.ue_slices], 0
+        )
+
+
+Scheduler.register("rr", RoundRobinScheduler)
+Scheduler.register("pf", ProportionalFairScheduler)
+Scheduler.register("max_se", MaxSEScheduler)
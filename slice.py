@@ -1,9 +1,11 @@
 import os
-from itertools import cycle
 
 import matplotlib.pyplot as plt
 import numpy as np
 
+from buffer import BufferBank
+from history import HistoryStore
+from scheduler import Scheduler
 from ue import UE
 
 
@@ -11,10 +13,26 @@ class Slice:
     """
     Slice class containing the slice functions. Each slice has a list with UEs
     and it is responsible to allocate the RBs allocated to the slice to the UEs
-    following a Round Robin algorithm. Each slice will be assigned to a base
-    station.
+    following an intra-slice scheduler (Round Robin by default, see the
+    Scheduler class). Each slice will be assigned to a base
+    station. The UE buffers are rows of a BufferBank, so the packets of all
+    slice UEs are sent and received at once. Likewise, the last hist values
+    of the slice UEs are rows of a matrix, so the slice hist is the mean of
+    its rows.
     """
 
+    hist_labels = [
+        "pkt_rcv",
+        "pkt_snt",
+        "pkt_thr",
+        "buffer_occ",
+        "avg_lat",
+        "pkt_loss",
+        "se",
+        "long_term_pkt_thr",
+        "fifth_perc_pkt_thr",
+    ]
+
     def __init__(
         self,
         bs_name: str,
@@ -26,6 +44,18 @@ class Slice:
         plots: bool,
         save_hist: bool = False,
         root_path: str = ".",
+        buffer_bank: BufferBank = None,
+        max_number_steps: int = 2000,
+        history_level: str = "full",
+        history_decimation: int = 1,
+        hist_last: np.array = None,
+        no_windows_hist_last: np.array = None,
+        scheduler: str = "rr",
+        ues_hist_last: np.array = None,
+        ues_no_windows_hist_last: np.array = None,
+        history_writer=None,
+        history_chunk_size: int = 100,
+        plot_queue=None,
     ) -> None:
         self.bs_name = bs_name
         self.id = id
@@ -35,42 +65,100 @@ class Slice:
         self.requirements = requirements
         self.plots = plots
         self.save_hist_bool = save_hist
-        self.hist_labels = [
-            "pkt_rcv",
-            "pkt_snt",
-            "pkt_thr",
-            "buffer_occ",
-            "avg_lat",
-            "pkt_loss",
-            "se",
-            "long_term_pkt_thr",
-            "fifth_perc_pkt_thr",
-        ]
-        self.hist = {hist_label: np.array([]) for hist_label in self.hist_labels}
-        self.no_windows_hist = {
-            hist_label: np.array([]) for hist_label in self.hist_labels
-        }
-
-        # Added for plotting more graphs
-        self.aux_hist_labels = [
-            "id", # Slice id
-            "name", # Slice name
-        ]
-        self.aux_hist_labels.extend(req for req in self.requirements.keys()) # To save requirements
-        self.aux_hist = {hist_label: np.array([]) for hist_label in self.aux_hist_labels}
-        self.aux_hist["id"] = self.id
-        self.aux_hist["name"] = self.name
+        self.history_level = history_level
+        self.hist = HistoryStore(
+            self.hist_labels,
+            max_number_steps,
+            level=history_level,
+            decimation=history_decimation,
+            last=hist_last,
+        )
+        self.no_windows_hist = HistoryStore(
+            self.hist_labels,
+            max_number_steps,
+            level=history_level,
+            decimation=history_decimation,
+            last=no_windows_hist_last,
+        )
+
+        # Added for plotting more graphs, the requirements are saved with the
+        # slice id and name
+        self.aux_hist = HistoryStore(
+            list(self.requirements.keys()),
+            max_number_steps,
+            dtype=np.float64,
+            level="full" if history_level == "full" else "off",
+            decimation=history_decimation,
+        )
 
         self.ues_order = []
         self.num_rbgs_assigned = 0
-        self.rr_index = 0
+        self.scheduler_name = scheduler
+        self.scheduler = Scheduler.create(scheduler, [len(self.ues)])
         self.root_path = root_path
+        if buffer_bank is None:
+            # UEs created outside a basestation have their own buffers, so they
+            # are moved to a bank owned by the slice
+            buffer_bank = BufferBank.from_buffers([ue.buffer for ue in self.ues])
+            for i, ue in enumerate(self.ues):
+                ue.buffer = buffer_bank.get_buffer(i)
+        self.buffer_bank = buffer_bank
+        if ues_hist_last is None or ues_no_windows_hist_last is None:
+            ues_hist_last, ues_no_windows_hist_last = self.create_ues_hist_last()
+        self.ues_hist_last = ues_hist_last
+        self.ues_no_windows_hist_last = ues_no_windows_hist_last
+        # Saved hists are streamed in background when a HistoryWriter is given
+        self.history_writer = history_writer
+        self.history_chunk_size = history_chunk_size
+        # Plots are rendered out of the simulation when a PlotQueue is given
+        self.plot_queue = plot_queue
+        self.stream_hist()
+
+    def create_ues_hist_last(self) -> tuple:
+        """
+        Move the last hist values of UEs created outside a basestation to
+        matrices owned by the slice, where each row is a UE.
+        """
+        matrices = []
+        for hist_name in ["hist", "no_windows_hist"]:
+            stores = [getattr(ue, hist_name) for ue in self.ues]
+            matrix = np.array([store.get_last() for store in stores])
+            for i, store in enumerate(stores):
+                store.last = matrix[i]
+            matrices.append(matrix)
+
+        return tuple(matrices)
+
+    def reset(self, trial_number: int, requirements: dict) -> None:
+        """
+        Restart the slice for a new trial reusing the allocated structures. The
+        slice UEs are reset by the basestation, since they draw the initial
+        packets following the UE ids order.
+        """
+        self.trial_number = trial_number
+        self.requirements = requirements
+        self.hist.reset()
+        self.no_windows_hist.reset()
+        self.aux_hist.reset()
+        self.stream_hist()
+        self.ues_order = []
+        self.num_rbgs_assigned = 0
+        self.scheduler.reset()
+
+    @property
+    def rr_index(self) -> int:
+        """
+        Rotation of the round robin allocation in the current step.
+        """
+        return int(self.scheduler.rr_index[0])
 
     def add_ue(self, ue: UE) -> None:
         """
         Add a UE to the slice UEs list.
         """
         self.ues = np.append(self.ues, ue)
+        self.ues_hist_last, self.ues_no_windows_hist_last = self.create_ues_hist_last()
+        self.scheduler = Scheduler.create(self.scheduler_name, [len(self.ues)])
 
     def assign_rbs_slice(self, num_rbs: int) -> None:
         """
@@ -81,75 +169,89 @@ class Slice:
     def update_requirements(self, requirements: dict) -> None:
         self.requirements = requirements
 
-    def update_hist(self, hist_ues: list, hist_nowindows_ues: list) -> None:
+    def update_hist(self) -> None:
         """
         Update slice variables history to enable the record to external files.
         """
-        hist_ue_labels = [
-            "pkt_rcv",
-            "pkt_snt",
-            "pkt_thr",
-            "buffer_occ",
-            "avg_lat",
-            "pkt_loss",
-            "se",
-            "long_term_pkt_thr",
-            "fifth_perc_pkt_thr",
-        ]
-        hist_vars = np.array([])
-        hist_nowindows_vars = np.array([])
-        for label in hist_ue_labels:
-            hist_vars = np.append(
-                hist_vars, np.mean([hist_ue[label][-1] for hist_ue in hist_ues])
-            )
-            hist_nowindows_vars = np.append(
-                hist_nowindows_vars,
-                np.mean(
-                    [
-                        hist_nowindows_ue[label][-1]
-                        for hist_nowindows_ue in hist_nowindows_ues
-                    ]
-                ),
-            )
+        # UEs and slices share the same hist labels
+        self.hist.append(np.mean(self.ues_hist_last, axis=0))
+        self.no_windows_hist.append(np.mean(self.ues_no_windows_hist_last, axis=0))
 
-        for i, var in enumerate(self.hist.items()):
-            self.hist[var[0]] = np.append(self.hist[var[0]], hist_vars[i])
-            self.no_windows_hist[var[0]] = np.append(
-                self.no_windows_hist[var[0]], hist_nowindows_vars[i]
-            )
-        
         # Requirements
-        for req_label in self.requirements.keys():
-            if self.requirements[req_label] != 0:
-                self.aux_hist[req_label] = np.append(self.aux_hist[req_label], self.requirements[req_label])
-            else:
-                self.aux_hist[req_label] = np.append(self.aux_hist[req_label], 0) #-1)
+        if self.history_level == "full":
+            self.aux_hist.append(
+                [self.requirements[req_label] for req_label in self.aux_hist]
+            )
 
     def get_last_no_windows_hist(self) -> dict:
         """
         Return a hist variable containing the last iteration values.
         """
-        return {
-            hist_label: self.no_windows_hist[hist_label][-1].item()
-            for hist_label in self.hist_labels
-        }
+        return dict(
+            zip(self.hist_labels, self.no_windows_hist.get_last().tolist())
+        )
+
+    def get_hist_path(self) -> str:
+        return "{}/hist/{}/trial{}/slices/".format(
+            self.root_path, self.bs_name, self.trial_number
+        )
+
+    def stream_hist(self) -> None:
+        """
+        Stream the hists of the current trial to the history writer.
+        """
+        if self.history_writer is None:
+            return
+        path = self.get_hist_path()
+        self.no_windows_hist.stream(
+            self.history_writer,
+            path + "slice{}".format(self.id),
+            self.history_chunk_size,
+        )
+        self.aux_hist.stream(
+            self.history_writer,
+            path + "aux_slice{}".format(self.id),
+            self.history_chunk_size,
+        )
 
     def save_hist(self) -> None:
         """
         Save slice variables history to external file.
         """
-        path = "{}/hist/{}/trial{}/slices/".format(
-            self.root_path, self.bs_name, self.trial_number
-        )
-        try:
-            os.makedirs(path)
-        except OSError:
-            pass
+        path = self.get_hist_path()
+        if self.history_writer is None:
+            try:
+                os.makedirs(path)
+            except OSError:
+                pass
 
-        np.savez_compressed((path + "slice{}").format(self.id), **self.no_windows_hist)
-        np.savez_compressed((path + "aux_slice{}").format(self.id), **self.aux_hist)
+        self.no_windows_hist.save(
+            (path + "slice{}").format(self.id), self.history_writer
+        )
+        self.aux_hist.save(
+            (path + "aux_slice{}").format(self.id),
+            self.history_writer,
+            id=self.id,
+            name=self.name,
+        )
         if self.plots:
-            Slice.plot_metrics(self.bs_name, self.trial_number, self.id, self.root_path)
+            plot_args = (self.bs_name, self.trial_number, self.id, self.root_path)
+            if self.plot_queue is not None:
+                self.plot_queue.submit(
+                    Slice.render_metrics,
+                    np.array(
+                        [self.no_windows_hist[label] for label in self.hist_labels]
+                    ),
+                    self.trial_number,
+                    self.id,
+                    (path + "slice{}.png").format(self.id),
+                )
+            else:
+                # pyplot is not thread-safe, so the files are plotted in this
+                # thread after being written
+                if self.history_writer is not None:
+                    self.history_writer.flush()
+                Slice.plot_metrics(*plot_args)
 
     @staticmethod
     def read_hist(
@@ -197,8 +299,22 @@ class Slice:
         Plot slice performance obtained over a specific trial. Read the
         information from external file.
         """
-        hist = Slice.read_hist(bs_name, trial_number, slice_id, root_path)
+        Slice.render_metrics(
+            Slice.read_hist(bs_name, trial_number, slice_id, root_path),
+            trial_number,
+            slice_id,
+            "{}/hist/{}/trial{}/slices/slice{}.png".format(
+                root_path, bs_name, trial_number, slice_id
+            ),
+        )
 
+    @staticmethod
+    def render_metrics(
+        hist: np.array, trial_number: int, slice_id: int, path: str
+    ) -> None:
+        """
+        Plot the slice hist (one row per label) in a png file.
+        """
         title_labels = [
             "Received Throughput",
             "Sent Throughput",
@@ -228,10 +344,9 @@ class Slice:
             ax.scatter(np.arange(hist[i].shape[0]), hist[i])
             ax.grid()
         fig.tight_layout()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
         fig.savefig(
-            "{}/hist/{}/trial{}/slices/slice{}.png".format(
-                root_path, bs_name, trial_number, slice_id
-            ),
+            path,
             bbox_inches="tight",
             pad_inches=0,
             format="png",
@@ -247,31 +362,41 @@ class Slice:
     ) -> None:
         """
         Executes slice processing. It allocates the RBs received from the base
-        station to the UEs following a round robin algorithm.
+        station to the UEs following the slice scheduler.
         """
-        # Consider a round-robin allocation among UEs
-        # Priotizing UEs with higher ids first, then cycling through all
-        rbs_ues = np.zeros(len(self.ues))
-        pool = cycle(np.arange(len(rbs_ues))[::-1])
-        for i in np.arange(num_rbs_allocated): 
-            rbs_ues[next(pool)] += 1
-
-        rbs_ues = np.roll(rbs_ues, self.rr_index)
-        self.rr_index += 1 if self.rr_index < (len(self.ues) - 1) else -self.rr_index
+        # Allocations received from the optimization model may not be integers,
+        # they are rounded up as the RBs were counted before
+        rbs_ues = self.scheduler.allocate(
+            np.array([max(np.ceil(num_rbs_allocated), 0)], dtype=int),
+            np.array([ue.se_gain * ue.se[step_number] for ue in self.ues]),
+        ).astype(float)
 
         # Allocating assigned RBs to UEs
-        hist_ues = []
-        hist_nowindows_ues = []
+        pkt_throughputs = np.array(
+            [
+                ue.get_step_throughput(step_number, rbs_ues[i])
+                for i, ue in enumerate(self.ues)
+            ]
+        )
+        buffer_copy = self.buffer_bank.buffer # Saving the buffers for hist
+        self.buffer_bank.send_packets(pkt_throughputs)
+
         for i, ue in enumerate(self.ues):
-            ue.step(step_number, rbs_ues[i])
-            hist_ues.append(ue.hist)
-            hist_nowindows_ues.append(ue.no_windows_hist)
+            ue.record_step(step_number, buffer_copy[i])
+
+        # Updating the buffers for the next iteration
+        self.buffer_bank.receive_packets(
+            np.array([ue.draw_arrived_packets(step_number) for ue in self.ues])
+        )
+        for ue in self.ues:
+            ue.record_arrived_packets()
             if (step_number == (max_step_number - 1)) and self.save_hist_bool:
                 ue.save_hist()
-                ue.save_aux_hist() # Added for the linear model optimization
+                if ue.record_aux_hist:
+                    ue.save_aux_hist() # Added for the linear model optimization
 
         # Update slice history
-        self.update_hist(hist_ues, hist_nowindows_ues)
+        self.update_hist()
 
 
 def main():
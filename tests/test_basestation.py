@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+
+from basestation import Basestation
+
+traffic_types = np.concatenate(
+    (
+        np.repeat(["embb"], 4),
+        np.repeat(["urllc"], 3),
+        np.repeat(["be"], 3),
+    ),
+    axis=None,
+)
+traffic_throughputs = {
+    "light": {"embb": 15, "urllc": 1, "be": 15},
+    "moderate": {"embb": 25, "urllc": 5, "be": 25},
+}
+slice_requirements_traffics = {
+    "light": {
+        "embb": {"throughput": 10, "latency": 20, "pkt_loss": 0.2},
+        "urllc": {"throughput": 1, "latency": 1, "pkt_loss": 1e-5},
+        "be": {"long_term_pkt_thr": 5, "fifth_perc_pkt_thr": 2},
+    },
+    "moderate": {
+        "embb": {"throughput": 20, "latency": 20, "pkt_loss": 0.2},
+        "urllc": {"throughput": 5, "latency": 1, "pkt_loss": 1e-5},
+        "be": {"long_term_pkt_thr": 10, "fifth_perc_pkt_thr": 5},
+    },
+}
+env_args = dict(
+    bandwidth=1e8,
+    total_number_rbs=100,
+    number_ues=10,
+    max_number_steps=5,
+    max_number_trials=4,
+    initial_trial=3,
+    traffic_types=traffic_types,
+    traffic_throughputs=traffic_throughputs,
+    slice_requirements_traffics=slice_requirements_traffics,
+    windows_size_obs=1,
+    history_level="off",
+    record_aux_hist=False,
+    channel="synthetic",
+)
+
+
+def create_env(traffic_schedules: dict) -> Basestation:
+    return Basestation(
+        bs_name="test/",
+        rng=np.random.default_rng(10),
+        traffic_schedules=traffic_schedules,
+        **env_args,
+    )
+
+
+def run_trial(env: Basestation) -> None:
+    for _ in range(env.max_number_steps):
+        env.step(np.ones(3))
+
+
+def test_traffic_schedules_past_max_number_trials():
+    schedules_env = create_env(None)
+    traffic_schedules = {
+        trial: schedules_env.create_traffic_schedule() for trial in range(3, 5)
+    }
+    env = create_env(traffic_schedules)
+    env.reset()
+    trial_numbers = [env.trial_number]
+    for _ in range(4):
+        run_trial(env)
+        env.reset()
+        trial_numbers.append(env.trial_number)
+
+    assert trial_numbers == [3, 4, 3, 4, 3]
+    assert env.traffic_schedule is traffic_schedules[3]
+
+
+def test_traffic_schedules_missing_trial():
+    schedules_env = create_env(None)
+    env = create_env({3: schedules_env.create_traffic_schedule()})
+    env.reset()
+    run_trial(env)
+    with pytest.raises(Exception, match="No traffic schedule was given for trial 4"):
+        env.reset()
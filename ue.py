@@ -6,8 +6,10 @@ import numpy as np
 import copy as cp
 from numpy.random import BitGenerator
 
-from buffer import Buffer
+from buffer import Buffer, BufferBank
 from channel import Channel
+from history import HistoryStore, SparseHistoryStore
+from window import SlidingWindow, SortedWindow
 
 
 class UE:
@@ -16,6 +18,18 @@ class UE:
     for specific trials. Each UE will be assigned to a slice.
     """
 
+    hist_labels = [
+        "pkt_rcv",
+        "pkt_snt",
+        "pkt_thr",
+        "buffer_occ",
+        "avg_lat",
+        "pkt_loss",
+        "se",
+        "long_term_pkt_thr",
+        "fifth_perc_pkt_thr",
+    ]
+
     def __init__(
         self,
         bs_name: str,
@@ -29,12 +43,26 @@ class UE:
         packet_size: int = 128 * 8, # Original = 8192 * 8
         frequency: int = 2,
         total_number_rbs: int = 17,
+        max_number_steps: int = 2000,
         plots: bool = False,
         rng: BitGenerator = np.random.default_rng(),
         windows_size_obs: int = 1,
         windows_size: int = 10,
         normalize_obs: bool = False,
         root_path: str = ".",
+        buffer_bank: BufferBank = None,
+        buffer_index: int = 0,
+        history_level: str = "full",
+        history_decimation: int = 1,
+        record_aux_hist: bool = True,
+        hist_last: np.array = None,
+        no_windows_hist_last: np.array = None,
+        arrivals: np.array = None,
+        history_writer=None,
+        history_chunk_size: int = 100,
+        plot_queue=None,
+        channel: str = "recorded",
+        channel_seed: int = 0,
     ) -> None:
         self.bs_name = bs_name
         self.id = id
@@ -46,32 +74,43 @@ class UE:
         self.frequency = frequency
         self.total_number_rbs = total_number_rbs
         self.root_path = root_path
-        self.se = 3 * Channel.read_se_file(
-            "{}/se/trial{}_f{}_ue{}.npy", trial_number, frequency, id, self.root_path
-        )
+        self.max_number_steps = max_number_steps
+        # SE values from the channel backend (a view of the SE store values for
+        # recorded channels), the gain is applied when they are used
+        self.channel = channel
+        self.channel_seed = channel_seed
+        self.se = self.create_se()
+        self.se_gain = 3
         self.buffer_max_lat = buffer_max_lat
-        self.buffer = Buffer(max_packets_buffer, buffer_max_lat)
+        self.buffer = (
+            Buffer(max_packets_buffer, buffer_max_lat)
+            if buffer_bank is None
+            else buffer_bank.get_buffer(buffer_index)
+        )
         self.traffic_throughput = traffic_throughput
         self.windows_size_obs = windows_size_obs
         self.windows_size = windows_size
         self.plots = plots
         self.normalize_obs = normalize_obs
         self.get_arrived_packets = self.define_traffic_function()
-        self.hist_labels = [
-            "pkt_rcv",
-            "pkt_snt",
-            "pkt_thr",
-            "buffer_occ",
-            "avg_lat",
-            "pkt_loss",
-            "se",
-            "long_term_pkt_thr",
-            "fifth_perc_pkt_thr",
-        ]
-        self.hist = {hist_label: np.array([]) for hist_label in self.hist_labels}
-        self.no_windows_hist = {
-            hist_label: np.array([]) for hist_label in self.hist_labels
-        }
+        # Packets arriving before each step when they are precomputed for the
+        # episode (index 0 for the initial packets), otherwise drawn each step
+        self.arrivals = arrivals
+        self.history_level = history_level
+        self.hist = HistoryStore(
+            self.hist_labels,
+            max_number_steps,
+            level=history_level,
+            decimation=history_decimation,
+            last=hist_last,
+        )
+        self.no_windows_hist = HistoryStore(
+            self.hist_labels,
+            max_number_steps,
+            level=history_level,
+            decimation=history_decimation,
+            last=no_windows_hist_last,
+        )
         
         # Added for collecting simulation data to input in the linear model optimization
         self.aux_hist_labels = [
@@ -85,24 +124,108 @@ class UE:
             "part_pkts", # Part of packet that started sending in the previous step
             "se", # Spectral efficiency (bits/s/Hz)
         ]
-        self.aux_hist = {hist_label: np.array([]) for hist_label in self.aux_hist_labels}
-        self.aux_hist["id"] = self.id
-        self.aux_hist["slice"] = self.traffic_type
-        self.first_aux_update = True
+        # The lists of packets per age are mostly zeros, so only the nonzero
+        # values are recorded. It is only recorded with the full history level
+        # and can be disabled when the optimization model is not used.
+        self.record_aux_hist = record_aux_hist and history_level == "full"
+        self.aux_hist = HistoryStore(
+            ["real_served_thr", "rcv_pkts", "dropp_pkts", "part_pkts", "se"],
+            max_number_steps if self.record_aux_hist else 0,
+            dtype=np.float64,
+            level="full" if self.record_aux_hist else "off",
+        )
+        self.aux_sent_pkts = SparseHistoryStore(
+            buffer_max_lat + 1, max_number_steps if self.record_aux_hist else 0
+        )
+        self.aux_buff_pkts = SparseHistoryStore(
+            buffer_max_lat + 1, max_number_steps if self.record_aux_hist else 0
+        )
 
-        self.number_pkt_loss = np.array([])
+        # Windows used to calculate the hist values without summing the past
+        # values again in each step
+        self.pkt_loss_window = SlidingWindow(self.windows_size - 1, 3)
+        self.pkt_thr_window = SortedWindow(self.windows_size)
+        self.obs_window = SlidingWindow(self.windows_size_obs, len(self.hist_labels))
         self.rng = rng
+        # Saved hists are streamed in background when a HistoryWriter is given
+        self.history_writer = history_writer
+        self.history_chunk_size = history_chunk_size
+        # Plots are rendered out of the simulation when a PlotQueue is given
+        self.plot_queue = plot_queue
+        self.stream_hist()
 
+        self.receive_initial_packets()
+
+    def receive_initial_packets(self) -> None:
+        """
+        Fill the empty buffer with the packets arrived before the first step.
+        """
         # Added for capturing data for the optimization model
         self.partial_rec_pkts = 0
         self.partial_sent_pkts = 0
         self.last_real_served_thr = 0
-        self.pkt_received = self.get_arrived_packets()
+        self.draw_arrived_packets(-1)
         self.buffer.receive_packets(self.pkt_received)
         self.dropped_pkts = self.buffer.dropped_packets
         self.buffer_array = cp.copy(self.buffer.buffer)
-        
 
+    def create_se(self) -> np.array:
+        return Channel.create_se(
+            self.channel,
+            self.trial_number,
+            self.frequency,
+            self.id,
+            self.max_number_steps,
+            self.root_path,
+            self.channel_seed,
+        )
+
+    def reset(
+        self, trial_number: int, traffic_throughput: float, arrivals: np.array = None
+    ) -> None:
+        """
+        Restart the UE for a new trial reusing the allocated structures, with
+        the same state of a UE created for this trial. The buffer is emptied
+        and the packets arrived before the first step are drawn again.
+        """
+        self.trial_number = trial_number
+        self.arrivals = arrivals
+        self.se = self.create_se()
+        self.traffic_throughput = traffic_throughput
+        self.buffer.reset()
+        for store in [
+            self.hist,
+            self.no_windows_hist,
+            self.aux_hist,
+            self.aux_sent_pkts,
+            self.aux_buff_pkts,
+        ]:
+            store.reset()
+        for window in [self.pkt_loss_window, self.pkt_thr_window, self.obs_window]:
+            window.reset()
+        self.stream_hist()
+        self.receive_initial_packets()
+
+    def get_hist_path(self) -> str:
+        return "{}/hist/{}/trial{}/ues/".format(
+            self.root_path, self.bs_name, self.trial_number
+        )
+
+    def stream_hist(self) -> None:
+        """
+        Stream the hists of the current trial to the history writer.
+        """
+        if self.history_writer is None:
+            return
+        path = self.get_hist_path()
+        self.no_windows_hist.stream(
+            self.history_writer, path + "ue{}".format(self.id), self.history_chunk_size
+        )
+        self.aux_hist.stream(
+            self.history_writer,
+            path + "aux_ue{}".format(self.id),
+            self.history_chunk_size,
+        )
 
     def define_traffic_function(self):
         """
@@ -168,7 +291,7 @@ class UE:
         return self.partial_sent_pkts + (
                 (number_rbs_allocated / self.total_number_rbs)
                 * self.bandwidth
-                * self.se[step_number]/1e3 # Because SE is in seconds and we want for ms
+                * (self.se_gain * self.se[step_number])/1e3 # Because SE is in seconds and we want for ms
             )
 
     def get_pkt_throughput(
@@ -207,78 +330,42 @@ class UE:
         using a windows calculation and it is used as basis to calculate the
         hist variable using windows average.
         """
-        hist_vars = [
-            self.packets_to_mbps(self.packet_size, packets_received),
-            self.packets_to_mbps(self.packet_size, packets_sent),
-            self.packets_to_mbps(self.packet_size, packets_throughput),
-            buffer_occupancy,
-            avg_latency,
-            pkt_loss,
-            self.se[step_number],
-        ]
         normalize_factors = (
             [100, 100, 100, 1, self.buffer_max_lat, 1, 100, 100, 100]
             if self.normalize_obs
             else np.ones(len(self.hist.keys()))
         )
-        self.number_pkt_loss = np.append(self.number_pkt_loss, pkt_loss)
 
-        # Hist with no windows for log (not used in the observation space)
-        idx = (
-            slice(-(self.windows_size - 1), None)
-            if self.windows_size != 1
-            else slice(0, 0)
+        # Hist with no windows for log (not used in the observation space). The
+        # packet loss window contains the last windows_size - 1 steps, including
+        # the current one
+        self.pkt_loss_window.push([packets_received, packets_sent, pkt_loss])
+        window_rcv, window_snt, window_loss = self.pkt_loss_window.sum()
+        window_rcv = self.packets_to_mbps(self.packet_size, window_rcv)
+        window_snt = self.packets_to_mbps(self.packet_size, window_snt)
+        pkt_rcv = self.packets_to_mbps(self.packet_size, packets_received)
+        buffer_pkts = (
+            self.buffer.get_buffer_n_pkts() + window_snt + window_loss - window_rcv
         )
-        for i, var in enumerate(self.no_windows_hist.items()):
-            if var[0] == "pkt_loss":
-                buffer_pkts = (
-                    np.sum(self.buffer.buffer)
-                    + np.sum(self.no_windows_hist["pkt_snt"][idx])
-                    + np.sum(self.number_pkt_loss[idx])
-                    - np.sum(self.no_windows_hist["pkt_rcv"][idx])
-                )
-                den = (
-                    np.sum(self.no_windows_hist["pkt_rcv"][idx])
-                    + hist_vars[0]
-                    + buffer_pkts
-                )
-                self.no_windows_hist[var[0]] = (
-                    np.append(
-                        self.no_windows_hist[var[0]],
-                        (np.sum(self.number_pkt_loss[idx]) + hist_vars[i]) / den,
-                    )
-                    if den != 0
-                    else np.append(self.no_windows_hist[var[0]], 0)
-                )
-            elif var[0] == "long_term_pkt_thr":
-                self.no_windows_hist[var[0]] = np.append(
-                    self.no_windows_hist[var[0]],
-                    np.sum(self.no_windows_hist["pkt_thr"][-self.windows_size :])
-                    / self.no_windows_hist["pkt_thr"][-self.windows_size :].shape[0],
-                )
-            elif var[0] == "fifth_perc_pkt_thr":
-                self.no_windows_hist[var[0]] = np.append(
-                    self.no_windows_hist[var[0]],
-                    np.percentile(
-                        self.no_windows_hist["pkt_thr"][-self.windows_size :], 5
-                    ),
-                )
-            else:
-                self.no_windows_hist[var[0]] = np.append(
-                    self.no_windows_hist[var[0]], hist_vars[i]
-                )
+        den = window_rcv + pkt_rcv + buffer_pkts
+        pkt_thr = self.packets_to_mbps(self.packet_size, packets_throughput)
+        self.pkt_thr_window.push(pkt_thr)
+        hist_vars = [
+            pkt_rcv,
+            self.packets_to_mbps(self.packet_size, packets_sent),
+            pkt_thr,
+            buffer_occupancy,
+            avg_latency,
+            (window_loss + pkt_loss) / den if den != 0 else 0,
+            self.se_gain * self.se[step_number],
+            self.pkt_thr_window.mean()[0],
+            self.pkt_thr_window.percentile(5),
+        ]
+        self.no_windows_hist.append(hist_vars)
 
         # Hist calculation to be used as observation space (using windows and normalization if applied)
-        idx_obs = slice(-(self.windows_size_obs), None)
-        for i, var in enumerate(self.hist.items()):
-            value = (
-                np.mean(self.no_windows_hist[var[0]][idx_obs])
-                if self.no_windows_hist[var[0]].shape[0] != 0
-                else 0
-            )
-            self.hist[var[0]] = np.append(
-                self.hist[var[0]], value / normalize_factors[i]
-            )
+        self.obs_window.push(hist_vars)
+        self.hist.append(self.obs_window.mean() / normalize_factors)
 
     def update_aux_hist(
         self,
@@ -292,53 +379,93 @@ class UE:
     ) -> None:
         '''
         Update the aux variables history to enable the record to external files,
-        which are used for the linear model optmization.
+        which are used for the linear model optmization. It is only recorded
+        using the full history level.
         '''
         
-        if self.first_aux_update:
-            self.aux_hist["buff_pkts"] = np.vstack([buff_pkts])
-            self.aux_hist["sent_pkts"] = np.vstack([sent_pkts])
-        else:
-            self.aux_hist["buff_pkts"] = np.vstack([self.aux_hist["buff_pkts"], buff_pkts])
-            self.aux_hist["sent_pkts"] = np.vstack([self.aux_hist["sent_pkts"], sent_pkts])
-        
-        self.aux_hist["real_served_thr"] = np.append(self.aux_hist["real_served_thr"], real_served_thr)
-        self.aux_hist["rcv_pkts"] = np.append(self.aux_hist["rcv_pkts"], rcv_pkts)
-        self.aux_hist["dropp_pkts"] = np.append(self.aux_hist["dropp_pkts"], dropp_pkts)
-        self.aux_hist["part_pkts"] = np.append(self.aux_hist["part_pkts"], part_pkts)
-        self.aux_hist["se"] = np.append(self.aux_hist["se"], se)
-
-        self.first_aux_update = False
+        self.aux_sent_pkts.append(sent_pkts)
+        self.aux_buff_pkts.append(buff_pkts)
+        self.aux_hist.append([real_served_thr, rcv_pkts, dropp_pkts, part_pkts, se])
 
     def save_hist(self) -> None:
         """
         Save variables history to external file.
         """
-        path = "{}/hist/{}/trial{}/ues/".format(
-            self.root_path, self.bs_name, self.trial_number
-        )
-        try:
-            os.makedirs(path)
-        except OSError:
-            pass
-
-        np.savez_compressed((path + "ue{}").format(self.id), **self.no_windows_hist)
+        path = self.get_hist_path()
+        if self.history_writer is None:
+            try:
+                os.makedirs(path)
+            except OSError:
+                pass
+
+        self.no_windows_hist.save((path + "ue{}").format(self.id), self.history_writer)
         if self.plots:
-            UE.plot_metrics(self.bs_name, self.trial_number, self.id, self.root_path)
+            plot_args = (self.bs_name, self.trial_number, self.id, self.root_path)
+            if self.plot_queue is not None:
+                self.plot_queue.submit(
+                    UE.render_metrics,
+                    np.array(
+                        [self.no_windows_hist[label] for label in self.hist_labels]
+                    ),
+                    self.trial_number,
+                    self.id,
+                    (path + "ue{}.png").format(self.id),
+                )
+            else:
+                # pyplot is not thread-safe, so the files are plotted in this
+                # thread after being written
+                if self.history_writer is not None:
+                    self.history_writer.flush()
+                UE.plot_metrics(*plot_args)
     
     def save_aux_hist(self) -> None:
         """
         Save aux variables history to external file.
         """
-        path = "{}/hist/{}/trial{}/ues/".format(
-            self.root_path, self.bs_name, self.trial_number
+        path = self.get_hist_path()
+        if self.history_writer is None:
+            try:
+                os.makedirs(path)
+            except OSError:
+                pass
+
+        self.aux_hist.save(
+            (path + "aux_ue{}").format(self.id),
+            self.history_writer,
+            id=self.id,
+            slice=self.traffic_type,
+            **self.aux_sent_pkts.to_dict("sent_pkts"),
+            **self.aux_buff_pkts.to_dict("buff_pkts"),
         )
-        try:
-            os.makedirs(path)
-        except OSError:
-            pass
 
-        np.savez_compressed((path + "aux_ue{}").format(self.id), **self.aux_hist)
+    @staticmethod
+    def load_aux_hist(path: str) -> dict:
+        """
+        Read aux variables history from an external file, returning the lists of
+        sent and buffer packets per age as 2-D arrays (steps, ages).
+        """
+        data = np.load(path)
+        aux_hist = {
+            label: data[label]
+            for label in data.files
+            if not label.startswith(("sent_pkts", "buff_pkts"))
+        }
+        aux_hist["sent_pkts"] = SparseHistoryStore.to_dense(data, "sent_pkts")
+        aux_hist["buff_pkts"] = SparseHistoryStore.to_dense(data, "buff_pkts")
+        return aux_hist
+
+    @staticmethod
+    def read_aux_hist(
+        bs_name: str, trial_number: int, ue_id: int, root_path: str = "."
+    ) -> dict:
+        """
+        Read aux variables history from external file.
+        """
+        return UE.load_aux_hist(
+            "{}/hist/{}/trial{}/ues/aux_ue{}.npz".format(
+                root_path, bs_name, trial_number, ue_id
+            )
+        )
 
     @staticmethod
     def read_hist(
@@ -373,8 +500,22 @@ class UE:
         Plot UE performance obtained over a specific trial. Read the
         information from external file.
         """
-        hist = UE.read_hist(bs_name, trial_number, ue_id, root_path)
+        UE.render_metrics(
+            UE.read_hist(bs_name, trial_number, ue_id, root_path),
+            trial_number,
+            ue_id,
+            "{}/hist/{}/trial{}/ues/ue{}.png".format(
+                root_path, bs_name, trial_number, ue_id
+            ),
+        )
 
+    @staticmethod
+    def render_metrics(
+        hist: np.array, trial_number: int, ue_id: int, path: str
+    ) -> None:
+        """
+        Plot the UE hist (one row per label) in a png file.
+        """
         title_labels = [
             "Received Throughput",
             "Sent Throughput",
@@ -404,10 +545,9 @@ class UE:
             ax.scatter(np.arange(hist[i].shape[0]), hist[i])
             ax.grid()
         fig.tight_layout()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
         fig.savefig(
-            "{}/hist/{}/trial{}/ues/ue{}.png".format(
-                root_path, bs_name, trial_number, ue_id
-            ),
+            path,
             bbox_inches="tight",
             pad_inches=0,
             format="png",
@@ -419,17 +559,25 @@ class UE:
     def packets_to_mbps(packet_size, number_packets):
         return packet_size * number_packets / 1e3
 
-    def step(self, step_number: int, number_rbs_allocated: int) -> None:
+    def get_step_throughput(
+        self, step_number: int, number_rbs_allocated: int
+    ) -> float:
         """
-        Executes the UE packets processing. Assumes that the buffer is already
-        updated from the last step. Sends packets and updates the buffer with
-        new received packets for the next iteration.
+        Calculate the number of packets the UE can send in this step and save
+        the real served throughput for the hist. It must be called before the
+        buffer sends the packets.
         """
         pkt_throughput = self.get_pkt_throughput(step_number, number_rbs_allocated)
-        self.last_real_served_thr = self.get_real_pkt_throughput(step_number, number_rbs_allocated)
-        buffer_copy = cp.copy(self.buffer.buffer) # Saving the buffer for hist
+        self.last_real_served_thr = self.get_real_pkt_throughput(
+            step_number, number_rbs_allocated
+        )
+        return pkt_throughput
 
-        self.buffer.send_packets(pkt_throughput)
+    def record_step(self, step_number: int, buffer_copy: np.array) -> None:
+        """
+        Update the UE hists after the buffer sent the packets, where buffer_copy
+        is the buffer state before sending them.
+        """
         self.sent_array = buffer_copy - self.buffer.buffer # Saving the sent packets
 
         self.update_hist(
@@ -442,22 +590,54 @@ class UE:
             step_number,
         )
 
-        self.update_aux_hist(
-            self.last_real_served_thr,
-            self.pkt_received,
-            self.sent_array,
-            self.dropped_pkts,
-            buffer_copy,
-            self.partial_sent_pkts,
-            self.se[step_number]
+        if self.record_aux_hist:
+            self.update_aux_hist(
+                self.last_real_served_thr,
+                self.pkt_received,
+                self.sent_array,
+                self.dropped_pkts,
+                buffer_copy,
+                self.partial_sent_pkts,
+                self.se_gain * self.se[step_number]
+            )
+
+    def draw_arrived_packets(self, step_number: int = -1) -> int:
+        """
+        Draw the packets arriving to the buffer for the next iteration, or read
+        them from the precomputed arrivals.
+        """
+        self.pkt_received = (
+            self.get_arrived_packets()
+            if self.arrivals is None
+            else int(self.arrivals[step_number + 1])
         )
+        return self.pkt_received
 
-        # Updating the buffer for the next iteration
-        self.pkt_received = self.get_arrived_packets()
-        self.buffer.receive_packets(self.pkt_received)
+    def record_arrived_packets(self) -> None:
+        """
+        Save the buffer state after it received the packets for the next
+        iteration.
+        """
         self.buffer_array = cp.copy(self.buffer.buffer)
         self.dropped_pkts = self.buffer.dropped_packets
 
+    def step(self, step_number: int, number_rbs_allocated: int) -> None:
+        """
+        Executes the UE packets processing. Assumes that the buffer is already
+        updated from the last step. Sends packets and updates the buffer with
+        new received packets for the next iteration. Slices perform the same
+        sequence for all their UEs at once using a BufferBank.
+        """
+        pkt_throughput = self.get_step_throughput(step_number, number_rbs_allocated)
+        buffer_copy = cp.copy(self.buffer.buffer) # Saving the buffer for hist
+
+        self.buffer.send_packets(pkt_throughput)
+        self.record_step(step_number, buffer_copy)
+
+        # Updating the buffer for the next iteration
+        self.buffer.receive_packets(self.draw_arrived_packets(step_number))
+        self.record_arrived_packets()
+
 
 
 def main():
@@ -474,7 +654,7 @@ def main():
     )
 
     for i in range(2000):
-        #print("SE =",ue.se[i])
+        #print("SE =",ue.se_gain * ue.se[i])
         ue.step(i, 5)
     ue.save_hist()
 
@@ -0,0 +1,74 @@
+import numpy as np
+from stable_baselines3.common.vec_env.base_vec_env import VecEnv
+
+from batched_basestation import BatchedBasestation
+
+
+class BatchedBasestationEnv(VecEnv):
+    """
+    Stable Baselines3 VecEnv adapter of the BatchedBasestation, so agents
+    collect the transitions of all cells with a single vectorized step. The
+    attributes and methods are accessed in the Basestation of each cell.
+    """
+
+    def __init__(self, number_envs: int, seed: int = None, **basestation_args):
+        self.batched_env = BatchedBasestation(number_envs, seed, **basestation_args)
+        self.actions = None
+        super().__init__(
+            number_envs,
+            self.batched_env.single_observation_space,
+            self.batched_env.single_action_space,
+        )
+
+    def reset(self) -> np.array:
+        # The seeds given by seed() are consecutive, so the first one seeds all
+        # cells (see BatchedBasestation.reset())
+        obs, _ = self.batched_env.reset(seed=self._seeds[0])
+        self._reset_seeds()
+        self._reset_options()
+
+        return obs
+
+    def step_async(self, actions: np.array) -> None:
+        self.actions = actions
+
+    def step_wait(self) -> tuple:
+        obs, rewards, terminations, truncations, infos = self.batched_env.step(
+            self.actions
+        )
+        dones = terminations | truncations
+        step_infos = [{} for _ in range(self.num_envs)]
+        if np.any(dones):
+            for i in np.flatnonzero(dones):
+                step_infos[i]["terminal_observation"] = infos["final_obs"][i]
+                step_infos[i]["TimeLimit.truncated"] = bool(
+                    truncations[i] and not terminations[i]
+                )
+
+        return obs, rewards.astype(np.float32), dones, step_infos
+
+    def close(self) -> None:
+        self.batched_env.close()
+
+    def get_attr(self, attr_name: str, indices=None) -> list:
+        return [
+            getattr(self.batched_env.cells[i], attr_name)
+            for i in self._get_indices(indices)
+        ]
+
+    def set_attr(self, attr_name: str, value, indices=None) -> None:
+        for i in self._get_indices(indices):
+            setattr(self.batched_env.cells[i], attr_name, value)
+
+    def env_method(
+        self, method_name: str, *method_args, indices=None, **method_kwargs
+    ) -> list:
+        return [
+            getattr(self.batched_env.cells[i], method_name)(
+                *method_args, **method_kwargs
+            )
+            for i in self._get_indices(indices)
+        ]
+
+    def env_is_wrapped(self, wrapper_class, indices=None) -> list:
+        return [False for _ in self._get_indices(indices)]
@@ -0,0 +1,132 @@
+from bisect import bisect_left, insort
+from collections import deque
+
+import numpy as np
+
+
+class SlidingWindow:
+    """
+    Class containing the last values pushed to a window of fixed size, where
+    each column represents one variable. It keeps a running sum of the values
+    inside the window, so the window sum and mean are obtained in O(1) for each
+    step instead of summing the window again. The running sum is recalculated
+    from the stored values every time the window is completely replaced to
+    avoid accumulating rounding errors. A window with size 0 is always empty.
+    The windows of several entities can be stacked using a tuple as width,
+    e.g., (number of UEs, number of variables), as long as they receive values
+    at the same steps.
+    """
+
+    def __init__(self, size: int, width=1) -> None:
+        self.size = size
+        shape = width if isinstance(width, tuple) else (width,)
+        self.values = np.zeros((size,) + shape)
+        self.total = np.zeros(shape)
+        self.index = 0  # position to store the next values
+        self.count = 0  # number of values inside the window
+
+    def reset(self) -> None:
+        """
+        Remove all values from the window.
+        """
+        self.values[:] = 0
+        self.total[:] = 0
+        self.index = 0
+        self.count = 0
+
+    def push(self, values: np.array) -> None:
+        """
+        Add new values to the window, removing the oldest ones when the window
+        is full.
+        """
+        if self.size == 0:
+            return
+        self.total += values - self.values[self.index]
+        self.values[self.index] = values
+        self.index = (self.index + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+        if self.index == 0:
+            # Summed in a fixed order, so the total of each variable does not
+            # depend on the number of stacked windows
+            self.total = self.values[0].copy()
+            for values in self.values[1:]:
+                self.total += values
+
+    def sum(self) -> np.array:
+        """
+        Return the summation of the values inside the window.
+        """
+        return self.total.copy()
+
+    def mean(self) -> np.array:
+        """
+        Return the mean of the values inside the window (0 if it is empty).
+        """
+        return self.total / self.count if self.count != 0 else np.zeros_like(self.total)
+
+    def percentile(self, q: float) -> np.array:
+        """
+        Return the q-th percentile of each variable inside the window using the
+        same linear interpolation of np.percentile() (0 if it is empty).
+        """
+        if self.count == 0:
+            return np.zeros_like(self.total)
+        return SlidingWindow.interpolate(
+            np.sort(self.values[: self.count], axis=0), self.count, q
+        )
+
+    @staticmethod
+    def interpolate(sorted_values, count: int, q: float):
+        """
+        Return the q-th percentile from the first count sorted values, where
+        each element of sorted_values can be a number or an array.
+        """
+        virtual_index = (count - 1) * (q / 100)
+        previous_index = int(np.floor(virtual_index))
+        next_index = min(previous_index + 1, count - 1)
+        gamma = virtual_index - previous_index
+        lower = sorted_values[previous_index]
+        upper = sorted_values[next_index]
+        return (
+            upper - (upper - lower) * (1 - gamma)
+            if gamma >= 0.5
+            else lower + (upper - lower) * gamma
+        )
+
+
+class SortedWindow(SlidingWindow):
+    """
+    Sliding window of a single variable that also keeps its values sorted,
+    finding the position of inserted and removed values with a binary search.
+    It enables obtaining order statistics (e.g., percentiles) of the window
+    without sorting it in every step.
+    """
+
+    def __init__(self, size: int) -> None:
+        super().__init__(size, 1)
+        self.arrival_order = deque()
+        self.sorted_values = []
+
+    def reset(self) -> None:
+        super().reset()
+        self.arrival_order.clear()
+        self.sorted_values.clear()
+
+    def push(self, value: float) -> None:
+        if self.size == 0:
+            return
+        if len(self.arrival_order) == self.size:
+            oldest_value = self.arrival_order.popleft()
+            del self.sorted_values[bisect_left(self.sorted_values, oldest_value)]
+        self.arrival_order.append(value)
+        insort(self.sorted_values, value)
+        super().push(value)
+
+    def percentile(self, q: float) -> float:
+        """
+        Return the q-th percentile of the window using the same linear
+        interpolation of np.percentile().
+        """
+        if self.count == 0:
+            return 0
+        return SlidingWindow.interpolate(self.sorted_values, self.count, q)